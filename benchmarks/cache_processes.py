@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Multi-process benchmark of the per-process cache and the shared cache.
+
+Each worker process reads the same values. With the per-process cache,
+every worker computes and keeps its own copy, with `SharedMemoryCache`
+they read the copy stored once in the memory mapped file.
+
+Reports the private memory growth of each worker (`RssAnon`, Linux only)
+and the hit latency.
+
+Usage:
+
+    python -m benchmarks.cache_processes
+
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from webapp2_caffeine.cache import LRUCache
+from webapp2_caffeine.cache import SharedMemoryCache
+
+
+WORKERS = 4
+KEYS = ['key-{}'.format(number) for number in range(2000)]
+VALUE_SIZE = 2048
+READS = 50000
+
+
+def rss_anon():
+    """Return the private memory of the process in kB."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+    return 0
+
+
+def fill(cache):
+    """Set a value for each key."""
+    for key in KEYS:
+        cache.set(key, key * (VALUE_SIZE // len(key)), time.time() + 3600)
+
+
+def worker(store_factory, results):
+    """Measure memory growth and hit latency of a store in a process."""
+    memory = rss_anon()
+    cache = store_factory()
+    if isinstance(cache, LRUCache):
+        fill(cache)
+    begin = time.time()
+    for index in range(READS):
+        cache.get(KEYS[index % len(KEYS)])
+    latency = (time.time() - begin) / READS * 1000000
+    results.put((rss_anon() - memory, latency))
+
+
+def run(store_factory):
+    """Return average `(memory kB, latency us)` over the workers."""
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker,
+                                         args=(store_factory, results))
+                 for dummy in range(WORKERS)]
+    for process in processes:
+        process.start()
+    measures = [results.get() for dummy in processes]
+    for process in processes:
+        process.join()
+    return (sum(measure[0] for measure in measures) / len(measures),
+            sum(measure[1] for measure in measures) / len(measures))
+
+
+class SharedFactory(object):
+    """Open the shared cache in the worker process."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        return SharedMemoryCache(self.path, slots=8192, slot_size=4096)
+
+
+def main():
+    """Print memory and latency of both stores."""
+    directory = tempfile.mkdtemp()
+    try:
+        factory = SharedFactory(os.path.join(directory, 'shared.cache'))
+        fill(factory())
+        print('{} workers, {} values of {} bytes'.format(
+            WORKERS, len(KEYS), VALUE_SIZE))
+        print('{:>18} {:>18} {:>12}'.format(
+            'store', 'private kB/worker', 'hit us'))
+        for name, store_factory in (('LRUCache', LRUCache),
+                                    ('SharedMemoryCache', factory)):
+            memory, latency = run(store_factory)
+            print('{:>18} {:>18.0f} {:>12.2f}'.format(name, memory, latency))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
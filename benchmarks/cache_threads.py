@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Threaded read benchmark of the instance cache stores.
+
+Under CPython the GIL serializes the reads, so both stores show about the
+same throughput whatever the number of threads (within +/-15%, either
+way, between runs). Sharding only avoids threads waiting behind another
+one's eviction or expiration work in a different shard.
+
+Usage:
+
+    python -m benchmarks.cache_threads
+
+"""
+import threading
+import time
+
+from webapp2_caffeine.cache import LRUCache
+from webapp2_caffeine.cache import ShardedCache
+
+
+KEYS = ['key-{}'.format(number) for number in range(1000)]
+READS = 20000
+
+
+def run(cache, threads_count):
+    """Return the cache reads per second with `threads_count` threads."""
+    for key in KEYS:
+        cache.set(key, key, time.time() + 3600)
+    start = threading.Event()
+
+    def worker():
+        start.wait()
+        get = cache.get
+        for index in range(READS):
+            get(KEYS[index % len(KEYS)])
+
+    threads = [threading.Thread(target=worker)
+               for dummy in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    begin = time.time()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return threads_count * READS / (time.time() - begin)
+
+
+def main():
+    """Print reads per second for both stores and several thread counts."""
+    print('{:>8} {:>14} {:>14}'.format('threads', 'LRUCache', 'ShardedCache'))
+    for threads_count in (1, 2, 4, 8, 16, 32):
+        single = run(LRUCache(), threads_count)
+        sharded = run(ShardedCache(shards=16), threads_count)
+        print('{:>8} {:>14.0f} {:>14.0f}'.format(threads_count, single,
+                                                 sharded))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,29 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
 import time
 import unittest
 
+from webapp2_caffeine.cache import CACHE
+from webapp2_caffeine.cache import cached
+from webapp2_caffeine.cache import CacheStats
+from webapp2_caffeine.cache import dump
 from webapp2_caffeine.cache import CacheContainer
 from webapp2_caffeine.cache import flush
+from webapp2_caffeine.cache import GENERATION_KEY
+from webapp2_caffeine.cache import INVALIDATIONS_KEY
+from webapp2_caffeine.cache import load
+from webapp2_caffeine.cache import LRUCache
+from webapp2_caffeine.cache import reset_stats
+from webapp2_caffeine.cache import ShardedCache
+from webapp2_caffeine.cache import SharedMemoryCache
+from webapp2_caffeine.cache import Snapshot
+from webapp2_caffeine.cache import sizeof
+from webapp2_caffeine.cache import stats
 
 
 class DummyCache(CacheContainer):
@@ -16,6 +35,46 @@ class DummyCache(CacheContainer):
         return datetime.now()
 
 
+class SlowCache(CacheContainer):
+
+    key = 'slow_cache'
+    calls = 0
+
+    @property
+    def fresh_value(self):
+        SlowCache.calls += 1
+        time.sleep(0.1)
+        return 'slow value'
+
+
+class EmptyCache(CacheContainer):
+
+    key = 'empty_cache'
+    negative_validity = 60
+    calls = 0
+
+    @property
+    def fresh_value(self):
+        EmptyCache.calls += 1
+        return []
+
+
+class StaleCache(CacheContainer):
+
+    key = 'stale_cache'
+    stale_validity = 60
+
+    @property
+    def fresh_value(self):
+        return 'fresh value'
+
+
+class SlowStaleCache(SlowCache):
+
+    key = 'slow_stale_cache'
+    stale_validity = 60
+
+
 class CacheContainerTest(unittest.TestCase):
 
     def setUp(self):
@@ -64,3 +123,420 @@ class CacheContainerTest(unittest.TestCase):
         old_value = container.value
         self.assertTrue(old_value)
         self.assertTrue(container.value, old_value)
+
+    def test_value_empty(self):
+        EmptyCache.calls = 0
+        container = EmptyCache()
+        self.assertEqual(container.get(), None)
+        self.assertEqual(container.get(123), 123)
+        self.assertEqual(container.value, [])
+        self.assertEqual(container.value, [])
+        self.assertEqual(container.get(123), [])
+        self.assertEqual(EmptyCache.calls, 1)
+        container = DummyCache()
+        container.set(None)
+        self.assertEqual(container.value, None)
+
+    def test_negative_validity(self):
+        container = EmptyCache()
+        value, expiration = container.set([])
+        self.assertTrue(50 < expiration - time.time() <= 60)
+        value, expiration = container.set(['promotion'])
+        self.assertTrue(21000 < expiration - time.time() <= 21600)
+
+    def test_value_single_flight(self):
+        SlowCache.calls = 0
+        results = []
+        start = threading.Event()
+
+        def worker():
+            start.wait()
+            results.append(SlowCache().value)
+
+        threads = [threading.Thread(target=worker) for dummy in range(50)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(SlowCache.calls, 1)
+        self.assertEqual(results, ['slow value'] * 50)
+
+    def test_value_stale_while_revalidate(self):
+        container = StaleCache()
+        container.set('stale value', time.time() - 1)
+        self.assertEqual(container.get(), None)
+        # The stale value is served while refreshed in background.
+        self.assertEqual(container.value, 'stale value')
+        for dummy in range(100):
+            if container.get():
+                break
+            time.sleep(0.01)
+        self.assertEqual(container.get(), 'fresh value')
+        self.assertEqual(container.value, 'fresh value')
+
+    def test_value_stale_single_refresh(self):
+        SlowCache.calls = 0
+        container = SlowStaleCache()
+        container.set('stale value', time.time() - 1)
+        threads_count = threading.active_count()
+        for dummy in range(50):
+            self.assertEqual(container.value, 'stale value')
+        # Only one refresh thread runs for all the stale reads.
+        self.assertEqual(threading.active_count(), threads_count + 1)
+        for dummy in range(100):
+            if container.get():
+                break
+            time.sleep(0.01)
+        self.assertEqual(container.get(), 'slow value')
+        self.assertEqual(SlowCache.calls, 1)
+
+    def test_value_stale_expired(self):
+        container = StaleCache()
+        container.set('stale value', time.time() - 61)
+        self.assertEqual(container.value, 'fresh value')
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 'value', time.time() + 60)
+        self.assertEqual(cache.get('a')[0], 'value')
+        self.assertIn('a', cache)
+        self.assertEqual(len(cache), 1)
+        cache.pop('a')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.size, 0)
+
+    def test_max_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch `a` so `b` is the least recently used entry.
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=sizeof('x' * 100) * 2)
+        cache.set('a', 'x' * 100)
+        cache.set('b', 'x' * 100)
+        cache.set('c', 'x' * 100)
+        self.assertEqual(cache.keys(), ['b', 'c'])
+        self.assertTrue(cache.size <= cache.max_bytes)
+        # Values bigger than the whole cache are not stored.
+        cache.set('d', 'x' * 1000)
+        self.assertEqual(cache.get('d'), None)
+
+    def test_reap_expired(self):
+        cache = LRUCache()
+        cache.set('a', 1, time.time() - 1)
+        cache.set('b', 2, time.time() + 60)
+        cache.set('c', 3)
+        # `a` is reclaimed without being read.
+        self.assertEqual(sorted(cache.keys()), ['b', 'c'])
+        self.assertEqual(cache.size, sizeof(2) + sizeof(3))
+
+
+class CacheStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        flush()
+        reset_stats()
+
+    def tearDown(self):
+        flush()
+        reset_stats()
+
+    def test_incr(self):
+        counters = CacheStats()
+        counters.incr('user:1', hits=1)
+        counters.incr('user:2', hits=2, misses=1)
+        self.assertEqual(counters.get()['user']['hits'], 3)
+        self.assertEqual(counters.get()['user']['misses'], 1)
+        counters.enabled = False
+        counters.incr('user:1', hits=1)
+        self.assertEqual(counters.get()['user']['hits'], 3)
+        counters.reset()
+        self.assertEqual(counters.get(), {})
+
+    def test_incr_threads(self):
+        counters = CacheStats(shards=4)
+
+        def worker():
+            for dummy in range(1000):
+                counters.incr('user:1', hits=1)
+
+        threads = [threading.Thread(target=worker) for dummy in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counters.get()['user']['hits'], 8000)
+        # Threads count in distinct shards.
+        self.assertEqual(len([groups for groups, lock in counters._shards
+                              if groups]), 4)
+
+    def test_stats(self):
+        container = DummyCache()
+        container.value
+        container.value
+        container.set('my value', time.time() - 1)
+        container.value
+        result = stats()
+        self.assertEqual(result['entries'], 1)
+        self.assertTrue(result['bytes'] > 0)
+        counters = result['keys']['dummy_cache']
+        self.assertEqual(counters['hits'], 1)
+        self.assertEqual(counters['misses'], 2)
+        self.assertEqual(counters['expirations'], 1)
+        self.assertEqual(counters['recomputes'], 2)
+        self.assertTrue(counters['recompute_time'] >= 0)
+
+    def test_evictions(self):
+        counters = CacheStats()
+        cache = LRUCache(max_entries=1, stats=counters)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(counters.get()['a']['evictions'], 1)
+
+
+class ShardedCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = ShardedCache(shards=4)
+        for key in range(100):
+            cache.set(key, key * 2)
+        self.assertEqual(len(cache), 100)
+        self.assertEqual(cache.get(50), (100, None))
+        self.assertEqual(sorted(cache.keys()), list(range(100)))
+        self.assertEqual(cache.pop(50), (100, None))
+        self.assertNotIn(50, cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_limits(self):
+        cache = ShardedCache(max_entries=10, max_bytes=1000, shards=4)
+        self.assertEqual(cache.shards[0].max_entries, 3)
+        self.assertEqual(cache.shards[0].max_bytes, 250)
+        for key in range(100):
+            cache.set(key, key)
+        self.assertTrue(len(cache) <= 12)
+
+    def test_max_bytes_big_value(self):
+        cache = ShardedCache(max_bytes=100000, shards=4)
+        value = 'x' * 50000
+        cache.set('small', 'small value')
+        # Bigger than a shard share but within the cache limit.
+        cache.set('big', value)
+        self.assertEqual(cache.get('big'), (value, None))
+        self.assertTrue(cache.size <= 100000)
+        cache.set('too big', 'x' * 200000)
+        self.assertEqual(cache.get('too big'), None)
+
+    def test_threads(self):
+        cache = ShardedCache(shards=4)
+        errors = []
+
+        def worker(number):
+            try:
+                for key in range(200):
+                    cache.set(key, number, time.time() + 0.001)
+                    cache.get(key)
+                    cache.pop(key - 1)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=worker, args=(number, ))
+                   for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(cache) <= 8)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        flush()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.snapshot')
+
+    def tearDown(self):
+        flush()
+        shutil.rmtree(self.directory)
+
+    def test_dump_load(self):
+        DummyCache().set({'my': 'value'})
+        value, expiration = EmptyCache().set([], time.time() - 1)
+        self.assertEqual(dump(self.path), 1)
+        flush()
+        self.assertEqual(load(self.path), 1)
+        self.assertEqual(DummyCache().get(), {'my': 'value'})
+        self.assertEqual(EmptyCache().get(), None)
+
+    def test_lazy_load(self):
+        container = DummyCache()
+        value, expiration = container.set('my value')
+        StaleCache().set('stale value')
+        dump(self.path)
+        flush()
+        load(self.path)
+        self.assertEqual(len(CACHE), 0)
+        self.assertEqual(len(CACHE.snapshot), 2)
+        self.assertEqual(CACHE.get(container.key), ('my value', expiration))
+        self.assertEqual(len(CACHE), 1)
+        self.assertEqual(len(CACHE.snapshot), 1)
+        # Dumping again keeps the entries not read yet.
+        self.assertEqual(dump(self.path), 2)
+        self.assertEqual(len(CACHE.snapshot), 1)
+        self.assertEqual(StaleCache().get(), 'stale value')
+
+    def test_set_delete(self):
+        DummyCache().set('my value')
+        StaleCache().set('stale value')
+        dump(self.path)
+        flush()
+        load(self.path)
+        DummyCache().delete()
+        StaleCache().set('new value')
+        self.assertEqual(DummyCache().get(), None)
+        self.assertEqual(StaleCache().get(), 'new value')
+        flush()
+        self.assertEqual(CACHE.snapshot, None)
+
+    def test_counters(self):
+        DummyCache().set('my value')
+        dump(self.path)
+        self.assertEqual(Snapshot(self.path).counters, {})
+        counters = {GENERATION_KEY: 2, INVALIDATIONS_KEY: 5}
+        Snapshot.write(self.path, CACHE.items(), counters)
+        self.assertEqual(Snapshot(self.path).counters, counters)
+        # Temporary files are renamed over the snapshot.
+        self.assertEqual(os.listdir(self.directory), ['cache.snapshot'])
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b'not a snapshot')
+        with self.assertRaises(ValueError):
+            load(self.path)
+
+
+def set_shared_value(path, key, value):
+    SharedMemoryCache(path, slots=64, slot_size=256).set(key, value)
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'shared.cache')
+        self.cache = SharedMemoryCache(self.path, slots=64, slot_size=256)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_get_set(self):
+        cache = self.cache
+        self.assertEqual(cache.get('a'), None)
+        expiration = time.time() + 60
+        cache.set('a', {'my': 'value'}, expiration)
+        self.assertEqual(cache.get('a'), ({'my': 'value'}, expiration))
+        cache.set('a', 'other value')
+        self.assertEqual(cache.get('a'), ('other value', None))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.pop('a'), ('other value', None))
+        self.assertEqual(cache.get('a'), None)
+
+    def test_expiration(self):
+        self.cache.set('a', 1, time.time() - 1)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_too_big(self):
+        self.cache.set('a', 'x' * 10)
+        self.cache.set('a', 'x' * 1000)
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_eviction(self):
+        for key in range(200):
+            self.cache.set(key, key)
+        self.assertEqual(len(self.cache), 64)
+        self.assertEqual(self.cache.get(199), (199, None))
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_processes(self):
+        process = multiprocessing.Process(
+            target=set_shared_value, args=(self.path, 'a', 'from child'))
+        process.start()
+        process.join()
+        self.assertEqual(self.cache.get('a'), ('from child', None))
+
+    def test_incompatible_file(self):
+        with self.assertRaises(ValueError):
+            SharedMemoryCache(self.path, slots=128, slot_size=256)
+
+    def test_container(self):
+        container = DummyCache()
+        container.store = self.cache
+        container.set('my value')
+        self.assertEqual(container.get(), 'my value')
+        self.assertEqual(CACHE.get(container.key), None)
+        flush()
+        self.assertEqual(container.get(), None)
+
+
+CALLS = []
+
+
+@cached(validity=60)
+def square(number):
+    CALLS.append(number)
+    return number * number
+
+
+@cached(key_func=lambda name, greeting='Hello': name)
+def greet(name, greeting='Hello'):
+    CALLS.append(name)
+    return '{} {}'.format(greeting, name)
+
+
+class CachedTest(unittest.TestCase):
+
+    def setUp(self):
+        flush()
+        del CALLS[:]
+
+    def tearDown(self):
+        flush()
+
+    def test_cached(self):
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(CALLS, [2, 3])
+
+    def test_validity(self):
+        container = square.container(2)
+        value, expiration = container.set(4)
+        self.assertTrue(50 < expiration - time.time() <= 60)
+
+    def test_key_func(self):
+        self.assertEqual(greet('Bob'), 'Hello Bob')
+        self.assertEqual(greet('Bob', greeting='Hi'), 'Hello Bob')
+        self.assertEqual(greet.container('Bob').key,
+                         'tests.test_cache.greet:Bob')
+        self.assertEqual(CALLS, ['Bob'])
+
+    def test_invalidate(self):
+        square(2)
+        square.invalidate(2)
+        square(2)
+        self.assertEqual(CALLS, [2, 2])
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from google.appengine.api import memcache
+
+from webapp2_caffeine import cache
+from webapp2_caffeine.cache import CacheContainer
+from webapp2_caffeine.cache import dump
+from webapp2_caffeine.cache import flush
+from webapp2_caffeine.cache import get_multi
+from webapp2_caffeine.cache import load
+from webapp2_caffeine.test_case import BaseTestCase
+
+
+class SharedCache(CacheContainer):
+
+    key = 'shared_cache'
+    use_memcache = True
+    calls = 0
+
+    @property
+    def fresh_value(self):
+        SharedCache.calls += 1
+        return 'shared value'
+
+
+class OtherSharedCache(SharedCache):
+
+    key = 'other_shared_cache'
+
+
+class DummyCache(CacheContainer):
+
+    def __init__(self, key):
+        self.key = key
+
+    @property
+    def fresh_value(self):
+        return self.key
+
+
+class MemcacheCacheContainerTest(BaseTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(MemcacheCacheContainerTest, self).setUp()
+        flush()
+        SharedCache.calls = 0
+        cache._GENERATIONS.clear()
+        cache._generations_checked = 0
+
+    def tearDown(self):
+        flush()
+        super(MemcacheCacheContainerTest, self).tearDown()
+
+    def test_set(self):
+        container = SharedCache()
+        value, expiration = container.set('my value')
+        entry = memcache.get(container._memcache_key)
+        self.assertEqual(entry, ('my value', expiration))
+
+    def test_get(self):
+        container = SharedCache()
+        container.set('my value')
+        # Another instance reads the value from memcache.
+        flush()
+        self.assertEqual(container.get(), 'my value')
+        memcache.flush_all()
+        self.assertEqual(container.get(), 'my value')
+
+    def test_get_expired(self):
+        container = SharedCache()
+        memcache.set(container._memcache_key, ('my value', time.time() - 1))
+        self.assertEqual(container.get(), None)
+
+    def test_delete(self):
+        container = SharedCache()
+        container.set('my value')
+        container.delete()
+        self.assertEqual(memcache.get(container._memcache_key), None)
+        self.assertEqual(container.get(), None)
+
+    def test_value(self):
+        container = SharedCache()
+        self.assertEqual(container.value, 'shared value')
+        flush()
+        self.assertEqual(container.value, 'shared value')
+        self.assertEqual(SharedCache.calls, 1)
+
+    def count_gets(self, func):
+        calls = []
+        memcache_get = memcache.get
+
+        def get(*args, **kwargs):
+            calls.append(args)
+            return memcache_get(*args, **kwargs)
+
+        memcache.get = get
+        try:
+            func()
+        finally:
+            memcache.get = memcache_get
+        return len(calls)
+
+    def test_value_memcache_rpcs(self):
+        # A miss reads memcache once before computing the value.
+        self.assertEqual(self.count_gets(lambda: SharedCache().value), 1)
+        self.assertEqual(SharedCache.calls, 1)
+
+    def test_get_multi(self):
+        SharedCache().set('first value')
+        flush()
+        values = []
+        gets = self.count_gets(lambda: values.extend(
+            get_multi([SharedCache(), OtherSharedCache()])))
+        self.assertEqual(values, ['first value', 'shared value'])
+        # Values missing from memcache are computed without another read.
+        self.assertEqual(gets, 0)
+        self.assertEqual(SharedCache.calls, 1)
+        self.assertEqual(OtherSharedCache().get(), 'shared value')
+
+
+class GenerationTest(BaseTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(GenerationTest, self).setUp()
+        flush()
+        SharedCache.calls = 0
+        cache._GENERATIONS.clear()
+        cache._generations_checked = 0
+
+    def tearDown(self):
+        flush()
+        super(GenerationTest, self).tearDown()
+
+    def expire_checks(self):
+        cache._generations_checked = 0
+
+    def test_flush_all_instances(self):
+        container = SharedCache()
+        self.assertEqual(container.value, 'shared value')
+        old_memcache_key = container._memcache_key
+        # Another instance flushes all the caches.
+        memcache.incr(cache.GENERATION_KEY, initial_value=0)
+        # Generations are not checked again before the interval.
+        self.assertEqual(container.get(), 'shared value')
+        self.expire_checks()
+        self.assertEqual(container.get(), None)
+        self.assertNotEqual(container._memcache_key, old_memcache_key)
+        self.assertEqual(container.value, 'shared value')
+        self.assertEqual(SharedCache.calls, 2)
+
+    def test_flush_current_instance(self):
+        container = SharedCache()
+        container.set('my value')
+        flush(all_instances=True)
+        self.assertEqual(memcache.get(cache.GENERATION_KEY), 1)
+        self.assertEqual(container.get(), None)
+
+    def test_delete_all_instances(self):
+        container = SharedCache()
+        other = OtherSharedCache()
+        container.set('my value')
+        other.set('other value')
+        container.get()
+        other.get()
+        # Another instance deletes the key.
+        cache._invalidate(container.key)
+        self.expire_checks()
+        self.assertEqual(container.get(), None)
+        self.assertEqual(other.get(), 'other value')
+
+    def test_delete_all_instances_lost(self):
+        container = SharedCache()
+        container.set('my value')
+        container.get()
+        # The deleted key was evicted from memcache.
+        memcache.incr(cache.INVALIDATIONS_KEY, initial_value=0)
+        self.expire_checks()
+        self.assertEqual(container.get(), None)
+        self.assertEqual(len(cache.CACHE), 0)
+
+    def test_delete_current_instance(self):
+        container = SharedCache()
+        container.set('my value')
+        container.delete(all_instances=True)
+        self.assertEqual(memcache.get(cache.INVALIDATIONS_KEY), 1)
+        log_key = '{}:1'.format(cache.INVALIDATIONS_KEY)
+        self.assertEqual(memcache.get(log_key), container.key)
+        self.assertEqual(container.get(), None)
+
+    def test_check_generations_rpcs(self):
+        calls = []
+        get_multi = memcache.get_multi
+
+        def counting_get_multi(*args, **kwargs):
+            calls.append(args)
+            return get_multi(*args, **kwargs)
+
+        memcache.get_multi = counting_get_multi
+        try:
+            for number in range(100):
+                DummyCache('key:{}'.format(number)).value
+        finally:
+            memcache.get_multi = get_multi
+        # Counters are checked once for all the keys and stay bounded.
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(cache._GENERATIONS), 2)
+
+    def test_check_generations_threads(self):
+        calls = []
+        get_multi = memcache.get_multi
+
+        def slow_get_multi(*args, **kwargs):
+            calls.append(args)
+            time.sleep(0.05)
+            return {}
+
+        memcache.get_multi = slow_get_multi
+        try:
+            threads = [threading.Thread(target=cache.check_generations)
+                       for dummy in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            memcache.get_multi = get_multi
+        # The threads reaching the interval together check once.
+        self.assertEqual(len(calls), 1)
+
+
+class SnapshotGenerationTest(BaseTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(SnapshotGenerationTest, self).setUp()
+        flush()
+        cache._GENERATIONS.clear()
+        cache._generations_checked = 0
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.snapshot')
+        DummyCache('first').set('first value')
+        DummyCache('second').set('second value')
+        # Record the counters, then dump.
+        cache.check_generations()
+        dump(self.path)
+
+    def tearDown(self):
+        flush()
+        shutil.rmtree(self.directory)
+        super(SnapshotGenerationTest, self).tearDown()
+
+    def restart(self):
+        """Load the snapshot in a new instance."""
+        flush()
+        cache._GENERATIONS.clear()
+        cache._generations_checked = 0
+        load(self.path)
+
+    def test_load(self):
+        self.restart()
+        self.assertEqual(DummyCache('first').get(), 'first value')
+
+    def test_load_flushed(self):
+        # Another instance flushes all the caches after the dump.
+        memcache.incr(cache.GENERATION_KEY, initial_value=0)
+        self.restart()
+        self.assertEqual(DummyCache('first').get(), None)
+        self.assertEqual(cache.CACHE.snapshot, None)
+
+    def test_load_deleted(self):
+        # Another instance deletes a key after the dump.
+        cache._invalidate('first')
+        self.restart()
+        self.assertEqual(DummyCache('first').get(), None)
+        self.assertEqual(DummyCache('second').get(), 'second value')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from jinja2 import Environment
+
+from webapp2_caffeine.cache import flush
+from webapp2_caffeine.fragment_cache import FragmentCacheExtension
+
+
+class FragmentCacheExtensionTest(unittest.TestCase):
+
+    def setUp(self):
+        flush()
+        self.calls = 0
+        self.environment = Environment(extensions=[FragmentCacheExtension])
+
+    def tearDown(self):
+        flush()
+
+    def count(self):
+        self.calls += 1
+        return self.calls
+
+    def render(self, source, **context):
+        template = self.environment.from_string(source)
+        return template.render(count=self.count, **context)
+
+    def test_cache(self):
+        source = '{% cache "menu" %}{{ count() }}{% endcache %}'
+        self.assertEqual(self.render(source), '1')
+        self.assertEqual(self.render(source), '1')
+        self.assertEqual(self.calls, 1)
+
+    def test_validity(self):
+        source = '{% cache "menu", 0 %}{{ count() }}{% endcache %}'
+        self.assertEqual(self.render(source), '1')
+        self.assertEqual(self.render(source), '2')
+
+    def test_vary_on(self):
+        source = ('{% cache "menu", 600, language %}{{ language }} '
+                  '{{ count() }}{% endcache %}')
+        self.assertEqual(self.render(source, language='en'), 'en 1')
+        self.assertEqual(self.render(source, language='fr'), 'fr 2')
+        self.assertEqual(self.render(source, language='en'), 'en 1')
+
+    def test_autoescape(self):
+        self.environment.autoescape = True
+        source = '{% cache "menu" %}{{ html }}{% endcache %}'
+        self.assertEqual(self.render(source, html='<b>'), '&lt;b&gt;')
+        self.assertEqual(self.render(source, html='<i>'), '&lt;b&gt;')
+
+    def test_unicode_name(self):
+        source = u'{% cache "menú" %}{{ count() }}{% endcache %}'
+        self.assertEqual(self.render(source), '1')
+        self.assertEqual(self.render(source), '1')
+        self.assertNotEqual(
+            self.render('{% cache "menu" %}{{ count() }}{% endcache %}'), '1')
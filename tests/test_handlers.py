@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+import json
 import unittest
 
+from google.appengine.ext import ndb
 from jinja2.exceptions import TemplateNotFound
 from webapp2 import Request, Response, WSGIApplication
 
+from webapp2_caffeine.cache import flush
+from webapp2_caffeine.cache import reset_stats
 from webapp2_caffeine.handlers import BaseRequestHandler
+from webapp2_caffeine.handlers import CacheStatsRequestHandler
+from webapp2_caffeine.handlers import ChildsRequestHandler
 from webapp2_caffeine.handlers import ImproperlyConfigured
+from webapp2_caffeine.handlers import ModelRequestHandler
 from webapp2_caffeine.handlers import TemplateRequestHandler
 from webapp2_caffeine.test_case import BaseTestCase, wsgi_config
 
@@ -16,9 +23,24 @@ class BaseHandler(BaseRequestHandler):
         self.response.write('Hello World ! {}')
 
 
+class SessionReadHandler(BaseRequestHandler):
+
+    def get(self, *args, **kwargs):
+        self.response.write(self.session.get('visits', 0))
+
+
+class SessionWriteHandler(BaseRequestHandler):
+
+    def get(self, *args, **kwargs):
+        self.session['visits'] = self.session.get('visits', 0) + 1
+        self.response.write(self.session['visits'])
+
+
 class BaseRequestHandlerTest(BaseTestCase, unittest.TestCase):
 
-    application = WSGIApplication([('/', BaseHandler)],
+    application = WSGIApplication([('/', BaseHandler),
+                                   ('/read', SessionReadHandler),
+                                   ('/write', SessionWriteHandler)],
                                   config=wsgi_config, debug=True)
 
     def setUp(self):
@@ -41,15 +63,64 @@ class BaseRequestHandlerTest(BaseTestCase, unittest.TestCase):
         # Ducktype auth object.
         self.assertEqual(handler.auth.request, self.request)
 
+    def test_dispatch_without_session(self):
+        response = self.testapp.get('/')
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_dispatch_session_read(self):
+        response = self.testapp.get('/read')
+        self.assertEqual(response.body, '0')
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_dispatch_session_write(self):
+        response = self.testapp.get('/write')
+        self.assertEqual(response.body, '1')
+        self.assertIn('Set-Cookie', response.headers)
+        response = self.testapp.get('/write')
+        self.assertEqual(response.body, '2')
+        # Reading the session doesn't write it back.
+        response = self.testapp.get('/read')
+        self.assertEqual(response.body, '2')
+        self.assertNotIn('Set-Cookie', response.headers)
+
 
 class TemplateHandler(TemplateRequestHandler):
 
     template_name = 'test_template.html'
 
 
+class CachedTemplateHandler(TemplateRequestHandler):
+
+    cache_timeout = 600
+    cache_vary_on = ('locale', 'query')
+    render_user_info = False
+    renders = 0
+
+    def render_page(self, **kwargs):
+        CachedTemplateHandler.renders += 1
+        return u'{} {}'.format(self.request.GET.get('q'), self.LANGUAGE)
+
+
+class CachedTextHandler(CachedTemplateHandler):
+
+    def render_page(self, **kwargs):
+        self.response.set_status(202)
+        self.response.content_type = 'text/plain'
+        return super(CachedTextHandler, self).render_page(**kwargs)
+
+
+class HtmlTemplateHandler(TemplateHandler):
+
+    def render_html(self, _template, **context):
+        self.response.write(_template)
+
+
 class TemplateRequestHandlerTest(BaseTestCase, unittest.TestCase):
 
-    application = WSGIApplication([('/', TemplateHandler)],
+    application = WSGIApplication([('/', TemplateHandler),
+                                   ('/html', HtmlTemplateHandler),
+                                   ('/cached', CachedTemplateHandler),
+                                   ('/text', CachedTextHandler)],
                                   config=wsgi_config, debug=True)
 
     def setUp(self):
@@ -67,6 +138,10 @@ class TemplateRequestHandlerTest(BaseTestCase, unittest.TestCase):
         with self.assertRaises(TemplateNotFound):
             self.testapp.get('/')
 
+    def test_get_render_html(self):
+        response = self.testapp.get('/html')
+        self.assertEqual(response.body, 'test_template.html')
+
     def test_get_template_name(self):
         handler = TemplateRequestHandler(self.request, self.response)
         with self.assertRaises(ImproperlyConfigured):
@@ -78,3 +153,262 @@ class TemplateRequestHandlerTest(BaseTestCase, unittest.TestCase):
         handler = TemplateRequestHandler(self.request, self.response)
         self.assertIn('view', handler.get_context_data())
         self.assertIn('test', handler.get_context_data(test=123))
+
+    def test_resolve_context(self):
+        @ndb.tasklet
+        def title():
+            article = yield self.article.key.get_async()
+            raise ndb.Return(article.title)
+
+        self.article = Article(title='Title')
+        self.article.put()
+        handler = TemplateRequestHandler(self.request, self.response)
+        context = handler.resolve_context({
+            'article': self.article.key.get_async(),
+            'articles': Article.query().fetch_async(),
+            'title': title(),
+            'view': handler})
+        self.assertEqual(context, {'article': self.article,
+                                   'articles': [self.article],
+                                   'title': 'Title',
+                                   'view': handler})
+
+    def test_get_page_cache(self):
+        flush()
+        CachedTemplateHandler.renders = 0
+        self.assertEqual(self.testapp.get('/cached?q=a').body, 'a en')
+        self.assertEqual(self.testapp.get('/cached?q=a').body, 'a en')
+        self.assertEqual(CachedTemplateHandler.renders, 1)
+        # Pages vary on query parameters and locale.
+        self.assertEqual(self.testapp.get('/cached?q=b').body, 'b en')
+        response = self.testapp.get('/cached?q=a', headers={
+            'Accept-Language': 'fr'})
+        self.assertEqual(response.body, 'a fr')
+        self.assertEqual(CachedTemplateHandler.renders, 3)
+
+    def test_get_page_cache_status(self):
+        flush()
+        CachedTemplateHandler.renders = 0
+        for dummy in range(2):
+            response = self.testapp.get('/text?q=a', status=202)
+            self.assertEqual(response.content_type, 'text/plain')
+            self.assertEqual(response.body, 'a en')
+        self.assertEqual(CachedTemplateHandler.renders, 1)
+
+    def test_get_page_cache_key(self):
+        handler = CachedTemplateHandler(self.request, self.response)
+        key = handler.get_page_cache_key()
+        self.assertTrue(key.startswith('tests.test_handlers.'
+                                       'CachedTemplateHandler:'))
+        handler.render_user_info = True
+        # Pages rendered with user info vary on the user.
+        self.assertNotEqual(handler.get_page_cache_key(), key)
+
+
+class Article(ndb.Model):
+
+    title = ndb.StringProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class ArticleHandler(ModelRequestHandler):
+
+    model = Article
+    template_name = 'article.html'
+    updated_property = 'updated'
+    render_user_info = False
+    renders = 0
+
+    def render_html(self, _template, **context):
+        ArticleHandler.renders += 1
+        self.response.write(context['object'].title)
+
+
+class ArticleContentHandler(ArticleHandler):
+
+    updated_property = None
+    etag_from_content = True
+
+
+class CachedArticleHandler(ArticleHandler):
+
+    cache_timeout = 600
+
+    def render_page(self, **kwargs):
+        ArticleHandler.renders += 1
+        return self.get_context_data(**kwargs)['object'].title
+
+
+class ModelRequestHandlerTest(BaseTestCase, unittest.TestCase):
+
+    application = WSGIApplication([('/content/<object_id>',
+                                    ArticleContentHandler),
+                                   ('/cached/<object_id>',
+                                    CachedArticleHandler),
+                                   ('/<object_id>', ArticleHandler)],
+                                  config=wsgi_config, debug=True)
+
+    def setUp(self):
+        super(ModelRequestHandlerTest, self).setUp()
+        ArticleHandler.renders = 0
+        self.article = Article(title='Title')
+        self.article.put()
+        self.url = '/{}'.format(self.article.key.id())
+
+    def test_get_not_found(self):
+        self.testapp.get('/0', status=404)
+
+    def test_get_if_none_match(self):
+        response = self.testapp.get(self.url)
+        self.assertEqual(response.body, 'Title')
+        etag = response.headers['ETag']
+        response = self.testapp.get(self.url, headers={'If-None-Match': etag},
+                                    status=304)
+        self.assertEqual(response.body, '')
+        self.assertEqual(ArticleHandler.renders, 1)
+        # Updating the entity changes the ETag.
+        self.article.title = 'New title'
+        self.article.put()
+        response = self.testapp.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.body, 'New title')
+
+    def test_get_page_cache(self):
+        flush()
+        url = '/cached/{}'.format(self.article.key.id())
+        response = self.testapp.get(url)
+        etag = response.headers['ETag']
+        self.assertEqual(self.testapp.get(url).body, 'Title')
+        self.assertEqual(ArticleHandler.renders, 1)
+        # Cached pages vary on the entity validators, like the ETag.
+        self.article.title = 'New title'
+        self.article.put()
+        response = self.testapp.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.body, 'New title')
+        self.testapp.get(url, headers={
+            'If-None-Match': response.headers['ETag']}, status=304)
+
+    def test_get_if_modified_since(self):
+        response = self.testapp.get(self.url)
+        last_modified = response.headers['Last-Modified']
+        self.testapp.get(self.url, headers={
+            'If-Modified-Since': last_modified}, status=304)
+        self.testapp.get(self.url, headers={
+            'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'}, status=200)
+        self.assertEqual(ArticleHandler.renders, 2)
+
+    def test_set_entity(self):
+        request = Request.blank(self.url)
+        request.route_kwargs = {}
+        handler = ArticleHandler(request, Response())
+        future = handler._set_entity_async(str(self.article.key.id()))
+        self.assertEqual(future.get_result(), None)
+        self.assertEqual(handler._entity, self.article)
+
+    def test_set_entity_get_by_id(self):
+        calls = []
+        get_by_id_async = Article.get_by_id_async
+
+        def counting_get_by_id_async(*args, **kwargs):
+            calls.append(args)
+            return get_by_id_async(*args, **kwargs)
+
+        Article.get_by_id_async = staticmethod(counting_get_by_id_async)
+        try:
+            self.testapp.get(self.url)
+        finally:
+            del Article.get_by_id_async
+        self.assertEqual(calls, [(self.article.key.id(), )])
+
+    def test_get_etag_from_content(self):
+        url = '/content/{}'.format(self.article.key.id())
+        response = self.testapp.get(url)
+        etag = response.headers['ETag']
+        response = self.testapp.get(url, headers={'If-None-Match': etag},
+                                    status=304)
+        self.assertEqual(response.body, '')
+
+
+class Comment(ndb.Model):
+
+    parent_class = Article
+    number = ndb.IntegerProperty()
+    text = ndb.StringProperty()
+
+
+class CommentsHandler(ChildsRequestHandler):
+
+    child_model = Comment
+    limit = 10
+
+    def queryset(self, ancestor):
+        return Comment.query(ancestor=ancestor).order(Comment.number)
+
+
+class ChildsRequestHandlerTest(BaseTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(ChildsRequestHandlerTest, self).setUp()
+        self.article = Article(title='Title')
+        self.article.put()
+        ndb.put_multi([Comment(parent=self.article.key, number=number,
+                               text='Comment {}'.format(number))
+                       for number in range(25)])
+
+    def get_context(self, url, **attributes):
+        handler = CommentsHandler(Request.blank(url), Response())
+        for name, value in attributes.iteritems():
+            setattr(handler, name, value)
+        return handler.get_context_data(parent_id=self.article.key.id())
+
+    def test_get_context_data(self):
+        context = self.get_context('/')
+        self.assertEqual(context['parent'], self.article)
+        self.assertEqual([comment.number for comment in context['items']],
+                         range(10))
+        self.assertTrue(context['pager'].has_next)
+
+    def test_get_context_data_page(self):
+        context = self.get_context('/?page=3')
+        self.assertEqual([comment.number for comment in context['items']],
+                         range(20, 25))
+        self.assertFalse(context['pager'].has_next)
+        context = self.get_context('/?page=invalid')
+        self.assertEqual(context['pager'].page, 1)
+
+    def test_get_context_data_projection(self):
+        context = self.get_context('/?page=2', projection=['number'])
+        self.assertEqual([comment.number for comment in context['items']],
+                         range(10, 20))
+        with self.assertRaises(ndb.UnprojectedPropertyError):
+            context['items'][0].text
+
+    def test_get_page_cache_key(self):
+        keys = set()
+        for url in ('/', '/?page=2', '/?page=3'):
+            handler = CommentsHandler(Request.blank(url), Response())
+            handler.render_user_info = False
+            keys.add(handler.get_page_cache_key())
+        self.assertEqual(len(keys), 3)
+
+    def test_get_context_data_hydrate(self):
+        context = self.get_context('/?page=2', hydrate=True)
+        self.assertEqual([comment.text for comment in context['items']],
+                         ['Comment {}'.format(number)
+                          for number in range(10, 20)])
+
+
+class CacheStatsRequestHandlerTest(BaseTestCase, unittest.TestCase):
+
+    application = WSGIApplication([('/', CacheStatsRequestHandler)],
+                                  config=wsgi_config, debug=True)
+
+    def setUp(self):
+        super(CacheStatsRequestHandlerTest, self).setUp()
+        flush()
+        reset_stats()
+
+    def test_get(self):
+        response = self.testapp.get('/')
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(response.body),
+                         {'entries': 0, 'bytes': 0, 'keys': {}})
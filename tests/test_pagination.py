@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+import base64
+import json
+import time
 import unittest
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
 
+from webapp2_caffeine.pagination import KeysetPager
+from webapp2_caffeine.pagination import MergedPager
 from webapp2_caffeine.pagination import Pager
 from webapp2_caffeine.test_case import BaseTestCase
 
@@ -85,11 +91,153 @@ class PagerTest(BaseTestCase, unittest.TestCase):
             results, cursor, more = pager.paginate(page_size=10)
             self.assertEqual(len(results), 10)
 
+    def test_paginate_async(self):
+        pager1 = Pager(self.query, page=1, lifetime=3600)
+        pager2 = Pager(self.query, page=3, lifetime=3600)
+        future1 = pager1.paginate_async(page_size=10)
+        future2 = pager2.paginate_async(page_size=10)
+        results, cursor, more = future2.get_result()
+        self.assertEqual(results[0].value, 20)
+        self.assertTrue(pager2.has_next)
+        results, cursor, more = future1.get_result()
+        self.assertEqual(results[0].value, 0)
+        self.assertTrue(pager1.has_next)
+
+    def test_paginate_caches_next_cursor(self):
+        pager = Pager(self.query, page=1, lifetime=3600)
+        pager.paginate(page_size=10)
+        # The cursor is cached in background.
+        eventloop.run()
+        cursor = pager._get_cursor_from_cache(page=2, page_size=10)
+        results, dummy, more = self.query.fetch_page(10, start_cursor=cursor)
+        self.assertEqual(results[0].value, 10)
+        self.assertEqual(pager._get_cursor_from_cache(page=3, page_size=10),
+                         None)
+
+    def test_paginate_prefetch(self):
+        pager = Pager(self.query, page=1, lifetime=3600, prefetch=3)
+        pager.paginate(page_size=10)
+        eventloop.run()
+        cursors = pager._get_cursors_from_cache(xrange(2, 7), page_size=10)
+        self.assertEqual(sorted(cursors), [2, 3, 4, 5])
+        results, dummy, more = self.query.fetch_page(10,
+                                                     start_cursor=cursors[5])
+        self.assertEqual(results[0].value, 40)
+
+    def test_total_count(self):
+        pager = Pager(self.query, page=1, lifetime=3600)
+        self.assertEqual(pager.total_count, 100)
+        self.assertFalse(pager.count_limited)
+        self.assertEqual(pager.page_count, 5)
+        pager.paginate(page_size=30)
+        self.assertEqual(pager.page_count, 4)
+        # The count is cached.
+        DummyModel(value=100).put()
+        pager = Pager(self.query, page=1, lifetime=3600)
+        self.assertEqual(pager.total_count, 100)
+
+    def test_total_count_limit(self):
+        pager = Pager(self.query, page=1, lifetime=3600)
+        pager.count_limit = 50
+        self.assertEqual(pager.total_count, 50)
+        self.assertTrue(pager.count_limited)
+
+    def test_total_count_limit_exact(self):
+        pager = Pager(self.query, page=1, lifetime=3600)
+        pager.count_limit = 100
+        self.assertEqual(pager.total_count, 100)
+        self.assertFalse(pager.count_limited)
+        self.assertEqual(pager.total_count_async().get_result(), 100)
+
+    def test_total_count_refresh(self):
+        pager = Pager(self.query, page=1, lifetime=3600)
+        memcache.set(pager._get_count_memcache_key(), (90, time.time() - 400))
+        self.assertEqual(pager.total_count_async().get_result(), 90)
+        eventloop.run()
+        self.assertEqual(pager.total_count_async().get_result(), 100)
+
+    def test_paginate_hydrate(self):
+        pager = Pager(self.query, page=2, lifetime=3600, hydrate=True)
+        results, cursor, more = pager.paginate(page_size=10)
+        self.assertEqual([entity.value for entity in results], range(10, 20))
+        self.assertTrue(more)
+        self.assertEqual(memcache.get(pager._get_results_memcache_key(10)),
+                         None)
+        # Projections are fetched directly.
+        results, cursor, more = pager.paginate(page_size=10,
+                                               projection=['value'])
+        self.assertEqual(results[0].value, 10)
+
+    def test_paginate_results_cache(self):
+        pager = Pager(self.query, page=1, lifetime=3600, hydrate=True,
+                      results_lifetime=60)
+        results, cursor, more = pager.paginate(page_size=10)
+        results[0].key.delete()
+        DummyModel(value=-1).put()
+        pager = Pager(self.query, page=1, lifetime=3600, hydrate=True,
+                      results_lifetime=60)
+        results, cursor, more = pager.paginate(page_size=10)
+        self.assertEqual([entity.value for entity in results], range(1, 10))
+        self.assertTrue(more)
+
+    def test_iter_all(self):
+        pager = Pager(self.query)
+        values = [entity.value for entity in pager.iter_all(batch_size=30)]
+        self.assertEqual(values, range(100))
+        batches = list(pager.iter_all(batch_size=30, batches=True))
+        self.assertEqual([len(batch) for batch in batches], [30, 30, 30, 10])
+
+    def test_iter_all_resume(self):
+        pager = Pager(self.query)
+        iterator = pager.iter_all(batch_size=30, batches=True)
+        next(iterator)
+        self.assertEqual(pager.iter_cursor, None)
+        next(iterator)
+        # The second batch isn't processed yet.
+        cursor = pager.iter_cursor.urlsafe()
+        pager = Pager(self.query)
+        values = [entity.value
+                  for entity in pager.iter_all(batch_size=30, cursor=cursor)]
+        self.assertEqual(values, range(30, 100))
+        # Iteration over, the cursor is after the last batch.
+        self.assertEqual(list(pager.iter_all(cursor=pager.iter_cursor)), [])
+
+    def test_iter_all_resume_mid_batch(self):
+        pager = Pager(self.query)
+        iterator = pager.iter_all(batch_size=30)
+        for dummy in range(45):
+            next(iterator)
+        # Resume from the start of the batch being processed.
+        cursor = pager.iter_cursor.urlsafe()
+        pager = Pager(self.query)
+        values = [entity.value
+                  for entity in pager.iter_all(batch_size=30, cursor=cursor)]
+        self.assertEqual(values, range(30, 100))
+
+    def test_get_cursor_caches_walk(self):
+        pager = Pager(self.query, page=5, lifetime=3600)
+        results, cursor, more = pager.paginate(page_size=10)
+        self.assertEqual(results[0].value, 40)
+        for page in xrange(2, 6):
+            cursor = pager._get_cursor_from_cache(page=page, page_size=10)
+            results, dummy, more = self.query.fetch_page(10,
+                                                         start_cursor=cursor)
+            self.assertEqual(results[0].value, (page - 1) * 10)
+
+    def test_get_cursor_resumes_walk(self):
+        dummy, cursor, more = self.query.fetch_page(30)
+        pager = Pager(self.query, page=6, lifetime=3600)
+        pager._set_cursor_to_cache(cursor, 4, page_size=10)
+        results, dummy, more = pager.paginate(page_size=10)
+        self.assertEqual(results[0].value, 50)
+        cursors = pager._get_cursors_from_cache(xrange(2, 7), page_size=10)
+        self.assertEqual(sorted(cursors), [4, 5, 6])
+
     def test_set_cursor_to_cache(self):
         dummy, cursor, more = self.query.fetch_page(10)
         pager = Pager(self.query, page=1, lifetime=3600)
         pager._set_cursor_to_cache(cursor, 2, page_size=10)
-        cursor_key = pager._get_memcache_key(page=2)
+        cursor_key = pager._get_memcache_key(2, page_size=10)
         result = memcache.get(cursor_key)
         self.assertEqual(result, cursor.to_bytes())
 
@@ -107,8 +255,161 @@ class PagerTest(BaseTestCase, unittest.TestCase):
         pager2 = Pager(query, page=1, lifetime=3600)
         self.assertNotEqual(pager1._query_id, pager2._query_id)
 
+    def test_query_id_canonical(self):
+        query = DummyModel.query(DummyModel.value > 10,
+                                 DummyModel.value < 20)
+        pager1 = Pager(query, page=1, lifetime=3600)
+        query = DummyModel.query(DummyModel.value < 20,
+                                 DummyModel.value > 10)
+        pager2 = Pager(query, page=1, lifetime=3600)
+        self.assertEqual(pager1._query_id, pager2._query_id)
+        query = DummyModel.query().order(-DummyModel.value)
+        pager3 = Pager(query, page=1, lifetime=3600)
+        self.assertNotEqual(Pager(self.query)._query_id, pager3._query_id)
+        query = DummyModel.query().order(-DummyModel.value)
+        self.assertEqual(pager3._query_id, Pager(query)._query_id)
+
+    def test_get_memcache_key_options(self):
+        pager = Pager(self.query, page=1, lifetime=3600)
+        key = pager._get_memcache_key(3, page_size=10)
+        self.assertEqual(key, pager._get_memcache_key(3, page_size=10))
+        self.assertNotEqual(key, pager._get_memcache_key(3, page_size=20))
+        self.assertNotEqual(key, pager._get_memcache_key(
+            3, page_size=10, projection=['value']))
+        self.assertEqual(key, pager._get_memcache_key(
+            3, page_size=10, batch_size=50))
+
+    def test_get_cursor_page_size(self):
+        pager = Pager(self.query, page=3, lifetime=3600)
+        pager.paginate(page_size=10)
+        pager = Pager(self.query, page=3, lifetime=3600)
+        results, cursor, more = pager.paginate(page_size=20)
+        self.assertEqual(results[0].value, 40)
+
     def test_get_memcache_key(self):
         pager = Pager(self.query, page=1, lifetime=3600)
         key = pager._get_memcache_key(page=3)
         self.assertIn('Pager-', key)
         self.assertIn('-3', key)
+
+
+class KeysetPagerTest(BaseTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(KeysetPagerTest, self).setUp()
+        # Two entities per value to test ties.
+        [DummyModel(value=x // 2).put() for x in range(100)]
+        self.query = DummyModel.query().order(DummyModel.value)
+
+    def paginate_all(self, query, page_size=10):
+        token, pages = None, []
+        while True:
+            pager = KeysetPager(query, token=token)
+            results, token, more = pager.paginate(page_size=page_size)
+            pages.append(results)
+            if not more:
+                return pages
+
+    def test_paginate(self):
+        pages = self.paginate_all(self.query, page_size=7)
+        entities = [entity for page in pages for entity in page]
+        self.assertEqual(len(pages), 15)
+        self.assertEqual(len(entities), 100)
+        self.assertEqual(len(set(entity.key for entity in entities)), 100)
+        self.assertEqual([entity.value for entity in entities],
+                         [x // 2 for x in range(100)])
+
+    def test_paginate_descending(self):
+        query = DummyModel.query().order(-DummyModel.value)
+        entities = [entity for page in self.paginate_all(query)
+                    for entity in page]
+        self.assertEqual(len(set(entity.key for entity in entities)), 100)
+        self.assertEqual(entities[0].value, 49)
+        self.assertEqual(entities[-1].value, 0)
+
+    def test_token(self):
+        pager = KeysetPager(self.query)
+        self.assertFalse(pager.has_prev)
+        results, token, more = pager.paginate(page_size=10)
+        pager = KeysetPager(self.query, token=token)
+        self.assertTrue(pager.has_prev)
+        results, token, more = pager.paginate(page_size=10)
+        self.assertEqual(results[0].value, 5)
+        self.assertTrue(pager)
+
+    def test_invalid_token(self):
+        pager = KeysetPager(self.query, token='invalid')
+        self.assertEqual(pager.token, None)
+        results, token, more = pager.paginate(page_size=10)
+        self.assertEqual(results[0].value, 0)
+
+    def test_invalid_token_values(self):
+        key = DummyModel.query().get().key.urlsafe()
+        for values in ([['v', 'abc'], ['k', key]],
+                       [['v', 1], ['k', 'garbage']],
+                       [['v', 1], ['x', 1]],
+                       [1, 2]):
+            token = base64.urlsafe_b64encode(json.dumps(values))
+            pager = KeysetPager(self.query, token=token)
+            self.assertEqual(pager.token, None)
+            results, token, more = pager.paginate(page_size=10)
+            self.assertEqual(results[0].value, 0)
+
+
+class MergedPagerTest(BaseTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(MergedPagerTest, self).setUp()
+        [DummyModel(value=x).put() for x in range(100)]
+
+    def paginate_all(self, queries, page_size=10):
+        token, pages = None, []
+        while True:
+            pager = MergedPager(queries, token=token)
+            results, token, more = pager.paginate(page_size=page_size)
+            pages.append([entity.value for entity in results])
+            if not more:
+                return pages
+
+    def test_paginate(self):
+        queries = [
+            DummyModel.query(DummyModel.value < 20).order(DummyModel.value),
+            DummyModel.query(DummyModel.value >= 85).order(DummyModel.value),
+            DummyModel.query(DummyModel.value == 50).order(DummyModel.value)]
+        pages = self.paginate_all(queries, page_size=7)
+        values = [value for page in pages for value in page]
+        self.assertEqual(values, range(20) + [50] + range(85, 100))
+        self.assertEqual(len(pages), 6)
+
+    def test_paginate_descending(self):
+        queries = [
+            DummyModel.query(DummyModel.value < 10).order(-DummyModel.value),
+            DummyModel.query(DummyModel.value > 95).order(-DummyModel.value)]
+        pages = self.paginate_all(queries, page_size=5)
+        self.assertEqual(pages[0], [99, 98, 97, 96, 9])
+        self.assertEqual(pages[-1], [4, 3, 2, 1, 0])
+
+    def test_paginate_duplicates(self):
+        queries = [
+            DummyModel.query(DummyModel.value < 50).order(DummyModel.value),
+            DummyModel.query(DummyModel.value >= 40).order(DummyModel.value)]
+        values = [value for page in self.paginate_all(queries, page_size=30)
+                  for value in page]
+        self.assertEqual(values, range(100))
+
+    def test_invalid_token(self):
+        queries = [DummyModel.query().order(DummyModel.value)]
+        for token in ('invalid',
+                      base64.urlsafe_b64encode(json.dumps(['garbage']))):
+            pager = MergedPager(queries, token=token)
+            self.assertEqual(pager.token, None)
+            results, token, more = pager.paginate(page_size=10)
+            self.assertEqual(results[0].value, 0)
+            self.assertTrue(pager)
+
+    def test_paginate_duplicate_on_page_boundary(self):
+        queries = [
+            DummyModel.query(DummyModel.value < 10).order(DummyModel.value),
+            DummyModel.query(DummyModel.value == 4).order(DummyModel.value)]
+        pages = self.paginate_all(queries, page_size=5)
+        self.assertEqual(pages, [range(5), range(5, 10)])
@@ -1,76 +1,1314 @@
 # -*- coding: utf-8 -*-
 """Utilities for in memory cache."""
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
 import logging
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import threading
 import time
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+
+try:
+    from appengine_config import cache_max_entries
+except ImportError:
+    cache_max_entries = 10000
+
+try:
+    from appengine_config import cache_max_bytes
+except ImportError:
+    cache_max_bytes = 64 * 1024 * 1024  # 64 MB
+
+try:
+    from appengine_config import cache_stats
+except ImportError:
+    cache_stats = True
+
+try:
+    from appengine_config import cache_shards
+except ImportError:
+    cache_shards = 16
+
+try:
+    from appengine_config import cache_generation_interval
+except ImportError:
+    cache_generation_interval = 30
+
+
+class CacheStats(object):
+    """Thread-safe cache counters per key group.
+
+    Keys are grouped on their part before the first colon, so the keys of
+    a `cached` function, or `'user:42'` style keys, share their counters.
+
+    Counters are split in shards with their own lock, each thread counts
+    in one shard and `get` adds the shards up.
+
+    Attributes:
+        enabled (bool) -- Count events.
+    """
+
+    fields = ('hits', 'misses', 'expirations', 'evictions', 'recomputes',
+              'recompute_time')
+
+    def __init__(self, enabled=True, shards=16):
+        """Set counters."""
+        self.enabled = enabled
+        self._shards = [({}, threading.Lock()) for dummy in range(shards)]
+        self._local = threading.local()
+        self._next_shard = itertools.count()
+
+    def incr(self, key, **amounts):
+        """Increment the counters of a key, e.g. `incr(key, hits=1)`."""
+        if not self.enabled:
+            return
+        group = str(key).split(':', 1)[0]
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = self._shards[
+                next(self._next_shard) % len(self._shards)]
+        groups, lock = shard
+        with lock:
+            counters = groups.get(group)
+            if counters is None:
+                counters = dict.fromkeys(self.fields, 0)
+                groups[group] = counters
+            for field, amount in amounts.items():
+                counters[field] += amount
+
+    def get(self):
+        """Return a copy of the counters `{group: {field: count}}`."""
+        totals = {}
+        for groups, lock in self._shards:
+            with lock:
+                for group, counters in groups.items():
+                    total = totals.setdefault(
+                        group, dict.fromkeys(self.fields, 0))
+                    for field, count in counters.items():
+                        total[field] += count
+        return totals
+
+    def reset(self):
+        """Reset all the counters."""
+        for groups, lock in self._shards:
+            with lock:
+                groups.clear()
+
+
+def sizeof(value, depth=3):
+    """Return the approximate size of a value in bytes.
+
+    Containers are followed up to `depth` levels, deeper objects are only
+    counted with their shallow size.
+    """
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sizeof(key, depth - 1) + sizeof(item, depth - 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += sizeof(item, depth - 1)
+    elif hasattr(value, '__dict__'):
+        size += sizeof(value.__dict__, depth - 1)
+    return size
+
+
+class LRUCache(object):
+    """Bounded mapping `{key: (value, expiration)}` with LRU eviction.
+
+    Get and set are O(1). Expired entries are reclaimed as soon as they
+    expire, on the next access to the cache, whatever their key.
+
+    Attributes:
+        max_entries (int) -- Maximum number of entries, `None` for no limit.
+        max_bytes (int) -- Maximum approximate size of the values in bytes,
+            `None` for no limit.
+        max_item_bytes (int) -- Maximum approximate size of a value, defaults
+            to `max_bytes`. A bigger one may stay alone over `max_bytes`.
+        size (int) -- Current approximate size of the values in bytes.
+        stats (CacheStats) -- Expirations and evictions counters, or None.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, stats=None,
+                 max_item_bytes=None):
+        """Set cache limits."""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.stats = stats
+        self.size = 0
+        self._data = collections.OrderedDict()
+        self._sizes = {}
+        self._expirations = []  # Heap of `(expiration, order, key)`.
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the `(value, expiration)` entry for key or `default`."""
+        with self._lock:
+            now = time.time()
+            self._reap(now)
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            if entry[1] is not None and entry[1] <= now:
+                self._discard(key)
+                if self.stats is not None:
+                    self.stats.incr(key, expirations=1)
+                return default
+            # Move the entry to the most recently used end.
+            self._data[key] = entry
+            return entry
+
+    def set(self, key, value, expiration=None):
+        """Store `(value, expiration)` for key and evict if needed."""
+        size = sizeof(value)
+        with self._lock:
+            self._reap(time.time())
+            self._pop(key)
+            max_item_bytes = self.max_bytes if self.max_item_bytes is None \
+                else self.max_item_bytes
+            if max_item_bytes is not None and size > max_item_bytes:
+                return
+            self._data[key] = (value, expiration)
+            self._sizes[key] = size
+            self.size += size
+            if expiration is not None:
+                heapq.heappush(self._expirations,
+                               (expiration, next(self._order), key))
+            self._evict()
+
+    def pop(self, key, default=None):
+        """Remove key and return its entry or `default`."""
+        with self._lock:
+            entry = self._pop(key)
+        return default if entry is None else entry
+
+    def clear(self):
+        """Remove all the entries."""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._expirations = []
+            self.size = 0
+
+    def keys(self):
+        """Return the list of keys, least recently used first."""
+        with self._lock:
+            return list(self._data.keys())
+
+    def items(self):
+        """Return the list of unexpired `(key, entry)`."""
+        now = time.time()
+        with self._lock:
+            return [(key, entry) for key, entry in self._data.items()
+                    if entry[1] is None or entry[1] > now]
+
+    def __contains__(self, key):
+        """Return True if key has an entry, expired or not."""
+        return key in self._data
+
+    def __getitem__(self, key):
+        """Return the entry for key, without expiration check."""
+        return self._data[key]
+
+    def __setitem__(self, key, entry):
+        """Store a `(value, expiration)` entry."""
+        value, expiration = entry
+        self.set(key, value, expiration)
+
+    def __delitem__(self, key):
+        """Remove key."""
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    def __len__(self):
+        """Return the number of entries."""
+        return len(self._data)
+
+    def _pop(self, key):
+        """Remove key, the lock must be held."""
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= self._sizes.pop(key, 0)
+        return entry
+
+    def _discard(self, key):
+        """Forget the size of a popped entry, the lock must be held."""
+        self.size -= self._sizes.pop(key, 0)
+
+    def _evict(self):
+        """Evict least recently used entries over limits.
+
+        The most recently used entry is kept, even bigger than `max_bytes`.
+        """
+        while len(self._data) > 1 and (
+                (self.max_entries is not None and
+                 len(self._data) > self.max_entries) or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            key, dummy = self._data.popitem(last=False)
+            self._discard(key)
+            if self.stats is not None:
+                self.stats.incr(key, evictions=1)
+
+    def _reap(self, now):
+        """Remove expired entries, the lock must be held."""
+        heap = self._expirations
+        while heap and heap[0][0] <= now:
+            expiration, dummy, key = heapq.heappop(heap)
+            entry = self._data.get(key)
+            # Skip heap items left by overwritten or deleted entries.
+            if entry is not None and entry[1] == expiration:
+                self._pop(key)
+                if self.stats is not None:
+                    self.stats.incr(key, expirations=1)
+        # Drop heap items left by overwritten entries.
+        if len(heap) > 2 * len(self._data) + 64:
+            self._expirations = [item for item in heap
+                                 if item[2] in self._data and
+                                 self._data[item[2]][1] == item[0]]
+            heapq.heapify(self._expirations)
+
+
+class Snapshot(object):
+    """Cache entries lazily read from a snapshot file.
+
+    The file is memory mapped and only its index is read on load, each value
+    is unpickled on its first access. Expirations are timestamps, so values
+    keep their remaining validity.
+
+    File format: magic string, index offset (unsigned long long), pickled
+    values, pickled `(index, counters)` where index is
+    `{key: (offset, length, expiration)}` and counters are the cross-instance
+    invalidation counters the entries were checked against, see `load`.
+
+    Attributes:
+        counters (dict) -- `{counter key: value}`, empty if unknown.
+    """
+
+    magic = b'webapp2_caffeine.cache.Snapshot.2\n'
+
+    def __init__(self, path):
+        """Read the index of a snapshot file."""
+        self._lock = threading.Lock()
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            start = len(self.magic)
+            if self._mmap[:start] != self.magic:
+                raise ValueError('Invalid cache snapshot {}'.format(path))
+            offset = struct.unpack('<Q', self._mmap[start:start + 8])[0]
+            index, self.counters = pickle.loads(self._mmap[offset:])
+        except Exception:
+            self._file.close()
+            raise
+        now = time.time()
+        self._index = dict(
+            (key, item) for key, item in index.items()
+            if item[2] is None or item[2] > now)
+
+    @classmethod
+    def write(cls, path, items, counters=None):
+        """Write entries to a snapshot file.
+
+        The file is replaced atomically, values which can't be pickled are
+        skipped. Processes can write the same path at the same time, the
+        last one wins.
+
+        Args:
+            path (str) -- Snapshot file path.
+            items (list) -- `(key, (value, expiration))` entries.
+            counters (dict) -- Invalidation counters of the entries.
+
+        Return:
+            (int) Number of entries written.
+
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            index = cls._write(os.fdopen(fd, 'wb'), items, counters or {})
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return len(index)
+
+    @classmethod
+    def _write(cls, snapshot_file, items, counters):
+        """Write entries to an open file and return the index."""
+        index = {}
+        with snapshot_file:
+            snapshot_file.write(cls.magic)
+            snapshot_file.write(struct.pack('<Q', 0))
+            for key, (value, expiration) in items:
+                try:
+                    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    msg = 'Cache value for {} can not be pickled'
+                    logging.warning(msg.format(key))
+                    continue
+                index[key] = (snapshot_file.tell(), len(data), expiration)
+                snapshot_file.write(data)
+            offset = snapshot_file.tell()
+            pickle.dump((index, counters), snapshot_file,
+                        pickle.HIGHEST_PROTOCOL)
+            snapshot_file.seek(len(cls.magic))
+            snapshot_file.write(struct.pack('<Q', offset))
+        return index
+
+    def pop(self, key):
+        """Remove key and return its `(value, expiration)` entry or None."""
+        with self._lock:
+            item = self._index.pop(key, None)
+            if item is None:
+                return None
+            offset, length, expiration = item
+            data = self._mmap[offset:offset + length]
+        if expiration is not None and expiration <= time.time():
+            return None
+        return pickle.loads(data), expiration
+
+    def discard(self, key):
+        """Remove key."""
+        with self._lock:
+            self._index.pop(key, None)
+
+    def items(self):
+        """Return the list of unexpired `(key, entry)` left.
+
+        Entries are read without being removed.
+        """
+        now = time.time()
+        items = []
+        with self._lock:
+            for key, (offset, length, expiration) in self._index.items():
+                if expiration is None or expiration > now:
+                    items.append((key, offset, length, expiration))
+            datas = [self._mmap[item[1]:item[1] + item[2]] for item in items]
+        return [(key, (pickle.loads(data), expiration))
+                for (key, dummy, dummy, expiration), data in zip(items, datas)]
+
+    def close(self):
+        """Close the snapshot file."""
+        with self._lock:
+            self._index.clear()
+            self._mmap.close()
+            self._file.close()
+
+    def __len__(self):
+        """Return the number of entries left."""
+        return len(self._index)
+
+
+class ShardedCache(object):
+    """LRU cache split in shards with their own lock.
+
+    Threads only wait for each other when accessing keys of the same
+    shard, so eviction or expiration work in one shard doesn't block
+    readers of the others. Under CPython the GIL already serializes the
+    short critical sections: read throughput is about the same as a single
+    `LRUCache`, see `benchmarks/cache_threads.py`. Each shard evicts its
+    own least recently used entries. Limits are split between
+    the shards, but a value up to `max_bytes` can still be stored alone in
+    its shard.
+
+    Attributes:
+        shards (list) -- `LRUCache` shards.
+        snapshot (Snapshot) -- Entries read on cache miss, or None.
+    """
+
+    snapshot = None
+
+    def __init__(self, max_entries=None, max_bytes=None, shards=16,
+                 stats=None):
+        """Create shards and split limits between them."""
+        self.shards = [LRUCache(stats=stats) for dummy in range(shards)]
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    @property
+    def max_entries(self):
+        """Return the maximum number of entries."""
+        return self._max_entries
+
+    @max_entries.setter
+    def max_entries(self, max_entries):
+        """Set the maximum number of entries."""
+        self._max_entries = max_entries
+        for shard in self.shards:
+            shard.max_entries = self._split(max_entries)
+
+    @property
+    def max_bytes(self):
+        """Return the maximum approximate size of the values in bytes."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        """Set the maximum approximate size of the values in bytes."""
+        self._max_bytes = max_bytes
+        for shard in self.shards:
+            shard.max_bytes = self._split(max_bytes)
+            shard.max_item_bytes = max_bytes
+
+    @property
+    def size(self):
+        """Return the approximate size of the values in bytes."""
+        return sum(shard.size for shard in self.shards)
+
+    def shard(self, key):
+        """Return the shard of a key."""
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key, default=None):
+        """Return the `(value, expiration)` entry for key or `default`."""
+        shard = self.shards[hash(key) % len(self.shards)]
+        entry = shard.get(key)
+        if entry is None and self.snapshot is not None:
+            entry = self.snapshot.pop(key)
+            if entry is not None:
+                shard.set(key, *entry)
+        return default if entry is None else entry
+
+    def set(self, key, value, expiration=None):
+        """Store `(value, expiration)` for key and evict if needed."""
+        if self.snapshot is not None:
+            self.snapshot.discard(key)
+        self.shards[hash(key) % len(self.shards)].set(key, value, expiration)
+
+    def pop(self, key, default=None):
+        """Remove key and return its entry or `default`."""
+        if self.snapshot is not None:
+            self.snapshot.discard(key)
+        return self.shard(key).pop(key, default)
+
+    def clear(self):
+        """Remove all the entries."""
+        snapshot, self.snapshot = self.snapshot, None
+        if snapshot is not None:
+            snapshot.close()
+        for shard in self.shards:
+            shard.clear()
+
+    def keys(self):
+        """Return the list of keys, snapshot entries not read excluded."""
+        return [key for shard in self.shards for key in shard.keys()]
+
+    def items(self):
+        """Return the list of unexpired `(key, entry)`."""
+        items = [item for shard in self.shards for item in shard.items()]
+        if self.snapshot is not None:
+            items.extend(self.snapshot.items())
+        return items
+
+    def __contains__(self, key):
+        """Return True if key has an entry, expired or not."""
+        return key in self.shard(key)
+
+    def __getitem__(self, key):
+        """Return the entry for key, without expiration check."""
+        return self.shard(key)[key]
+
+    def __setitem__(self, key, entry):
+        """Store a `(value, expiration)` entry."""
+        self.shard(key)[key] = entry
+
+    def __delitem__(self, key):
+        """Remove key."""
+        del self.shard(key)[key]
+
+    def __len__(self):
+        """Return the number of entries."""
+        return sum(len(shard) for shard in self.shards)
+
+    def _split(self, limit):
+        """Return the share of a limit for one shard."""
+        if limit is None:
+            return None
+        return -(-limit // len(self.shards))
+
+
+class SharedMemoryCache(object):
+    """Cache shared by the processes of a host in a memory mapped file.
+
+    The file is split in buckets of `ways` slots of `slot_size` bytes. A key
+    is stored in a slot of its bucket, replacing the entry which expires
+    first when the bucket is full. Buckets are locked with `fcntl` range
+    locks between processes and with thread locks inside a process.
+
+    Keys and values are pickled and must fit in a slot, bigger values are
+    not stored.
+
+    Example:
+
+        class MyCache(CacheContainer):
+            store = SharedMemoryCache('/tmp/my_app.cache')
+
+    Attributes:
+        path (str) -- Memory mapped file path.
+        slots (int) -- Number of slots.
+        slot_size (int) -- Size of a slot in bytes.
+        ways (int) -- Number of slots per bucket.
+        stats (CacheStats) -- Expirations and evictions counters, or None.
+    """
+
+    magic = b'webapp2_caffeine.cache.SharedMemoryCache.1\n'
+    file_header = struct.Struct('<{}sQQQ'.format(len(magic)))
+    slot_header = struct.Struct('<QdI')  # Key hash, expiration, data size.
+
+    def __init__(self, path, slots=16384, slot_size=4096, ways=8,
+                 stats=None):
+        """Open or create the memory mapped file."""
+        if fcntl is None:
+            raise NotImplementedError('SharedMemoryCache requires fcntl.')
+        self.path = path
+        self.slots = slots - slots % ways
+        self.slot_size = slot_size
+        self.ways = ways
+        self.stats = stats
+        self._buckets = self.slots // ways
+        self._locks = [threading.Lock() for dummy in range(64)]
+        length = self.file_header.size + self.slots * slot_size
+        header = self.file_header.pack(self.magic, self.slots, slot_size,
+                                       ways)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.ftruncate(self._fd, length)
+                    os.write(self._fd, header)
+                elif os.read(self._fd, len(header)) != header:
+                    raise ValueError(
+                        'Incompatible shared cache file {}'.format(path))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            self._mmap = mmap.mmap(self._fd, length)
+        except Exception:
+            os.close(self._fd)
+            raise
+        _SHARED_STORES.append(self)
+
+    def get(self, key, default=None):
+        """Return the `(value, expiration)` entry for key or `default`."""
+        key_hash = self._hash(key)
+        bucket = key_hash % self._buckets
+        with self._locked(bucket, shared=True):
+            slot, expiration, data = self._find(bucket, key_hash)
+        if slot is None:
+            return default
+        if expiration is not None and expiration <= time.time():
+            if self.stats is not None:
+                self.stats.incr(key, expirations=1)
+            return default
+        stored_key, value = pickle.loads(data)
+        if stored_key != key:
+            return default
+        return value, expiration
+
+    def set(self, key, value, expiration=None):
+        """Store `(value, expiration)` for key."""
+        data = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size - self.slot_header.size:
+            self.pop(key)
+            return
+        key_hash = self._hash(key)
+        bucket = key_hash % self._buckets
+        now = time.time()
+        with self._locked(bucket):
+            slot = self._find(bucket, key_hash)[0]
+            if slot is None:
+                slot = self._victim(bucket, now)
+            offset = self._offset(slot)
+            self.slot_header.pack_into(self._mmap, offset, key_hash,
+                                       expiration or 0, len(data))
+            start = offset + self.slot_header.size
+            self._mmap[start:start + len(data)] = data
+
+    def pop(self, key, default=None):
+        """Remove key and return its entry or `default`."""
+        key_hash = self._hash(key)
+        bucket = key_hash % self._buckets
+        with self._locked(bucket):
+            slot, expiration, data = self._find(bucket, key_hash)
+            if slot is None:
+                return default
+            self.slot_header.pack_into(self._mmap, self._offset(slot),
+                                       0, 0, 0)
+        stored_key, value = pickle.loads(data)
+        return value, expiration
+
+    def clear(self):
+        """Remove all the entries."""
+        for bucket in range(self._buckets):
+            with self._locked(bucket):
+                for slot in self._bucket_slots(bucket):
+                    self.slot_header.pack_into(
+                        self._mmap, self._offset(slot), 0, 0, 0)
+
+    @property
+    def size(self):
+        """Return the approximate size of the values in bytes."""
+        return sum(header[2] for header in self._headers())
+
+    def close(self):
+        """Close the memory mapped file."""
+        _SHARED_STORES.remove(self)
+        self._mmap.close()
+        os.close(self._fd)
+
+    def __len__(self):
+        """Return the approximate number of entries."""
+        return len(self._headers())
+
+    def _headers(self):
+        """Return the headers of the unexpired slots, without locking."""
+        now = time.time()
+        headers = [self.slot_header.unpack_from(self._mmap,
+                                                self._offset(slot))
+                   for slot in range(self.slots)]
+        return [header for header in headers
+                if header[0] and (not header[1] or header[1] > now)]
+
+    @staticmethod
+    def _hash(key):
+        """Return a non null key hash, stable between processes."""
+        digest = hashlib.md5(repr(key).encode('utf-8')).digest()
+        return struct.unpack('<Q', digest[:8])[0] or 1
+
+    def _offset(self, slot):
+        """Return the position of a slot in the file."""
+        return self.file_header.size + slot * self.slot_size
+
+    def _bucket_slots(self, bucket):
+        """Return the slots of a bucket."""
+        return range(bucket * self.ways, (bucket + 1) * self.ways)
+
+    def _find(self, bucket, key_hash):
+        """Return `(slot, expiration, data)` for a key hash, or Nones."""
+        for slot in self._bucket_slots(bucket):
+            offset = self._offset(slot)
+            slot_hash, expiration, length = self.slot_header.unpack_from(
+                self._mmap, offset)
+            if slot_hash == key_hash:
+                start = offset + self.slot_header.size
+                return slot, expiration or None, self._mmap[start:
+                                                            start + length]
+        return None, None, None
+
+    def _victim(self, bucket, now):
+        """Return a free slot, or the slot expiring first, of a bucket."""
+        victim, victim_expiration = None, None
+        for slot in self._bucket_slots(bucket):
+            slot_hash, expiration = self.slot_header.unpack_from(
+                self._mmap, self._offset(slot))[:2]
+            if not slot_hash or (expiration and expiration <= now):
+                return slot
+            expiration = expiration or float('inf')
+            if victim is None or expiration < victim_expiration:
+                victim, victim_expiration = slot, expiration
+        if self.stats is not None:
+            self.stats.incr('<shared>', evictions=1)
+        return victim
+
+    @contextlib.contextmanager
+    def _locked(self, bucket, shared=False):
+        """Lock a bucket between threads and processes."""
+        length = self.ways * self.slot_size
+        start = self._offset(bucket * self.ways)
+        with self._locks[bucket % len(self._locks)]:
+            fcntl.lockf(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX,
+                        length, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+
+# Shared memory caches opened by the process.
+_SHARED_STORES = []
+
+# Instance cache counters.
+STATS = CacheStats(enabled=cache_stats, shards=cache_shards)
 
 # Instance data cache `{key: (value, expiration)}`
-CACHE = {}
+CACHE = ShardedCache(max_entries=cache_max_entries,
+                     max_bytes=cache_max_bytes,
+                     shards=cache_shards,
+                     stats=STATS)
+
+# Returned by `CacheContainer.get` to tell a miss from a cached `None`.
+MISSING = object()
+
+# Prefix of the container keys in memcache.
+MEMCACHE_PREFIX = 'CacheContainer:'
+
+# Memcache key of the generation counter, incremented to invalidate the
+# instances caches.
+GENERATION_KEY = 'CacheContainerGeneration'
+
+# Memcache key of the counter of keys deleted from all the instances, the
+# key deleted by increment `n` is stored under `'<INVALIDATIONS_KEY>:<n>'`.
+INVALIDATIONS_KEY = 'CacheContainerInvalidations'
+
+# Maximum deleted keys read in a check, the whole cache is reset beyond.
+MAX_INVALIDATIONS = 1000
+
+# Counters known by the instance `{counter key: value}`
+_GENERATIONS = {}
+# Timestamp of the last counters check, updated with the lock held.
+_generations_checked = 0
+_GENERATIONS_LOCK = threading.Lock()
+
+# Keys being recomputed `{key: threading.Event}`
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def flush(all_instances=False):
+    """Reset the cache of the current instance.
+
+    Args:
+        all_instances (bool) -- Also reset the caches of the other instances,
+            within `cache_generation_interval` seconds.
+    """
+    if all_instances:
+        _incr_generation()
+    CACHE.clear()
+    for store in _SHARED_STORES:
+        store.clear()
+
+
+def dump(path):
+    """Write the instance cache to a snapshot file.
+
+    Call it from a shutdown hook, e.g. with
+    `google.appengine.api.runtime.set_shutdown_hook`, or to build a
+    snapshot shipped with the application.
+
+    The snapshot records the invalidation counters the instance last
+    checked, see `load`.
+
+    Args:
+        path (str) -- Snapshot file path.
+
+    Return:
+        (int) Number of entries written.
+
+    """
+    with _GENERATIONS_LOCK:
+        counters = dict(_GENERATIONS)
+    return Snapshot.write(path, CACHE.items(), counters)
+
+
+def load(path):
+    """Restore the instance cache from a snapshot file.
+
+    Values are read from the file on their first access, expired ones are
+    ignored. Previous snapshot entries not read yet are dropped.
+
+    The instance counters are set to the ones recorded in the snapshot,
+    so the next read checks them: the snapshot is dropped if the caches
+    were flushed since it was written, and keys deleted from all the
+    instances since are removed from it. Snapshots written before any
+    check, e.g. without memcache, are not checked.
+
+    Args:
+        path (str) -- Snapshot file path.
+
+    Return:
+        (int) Number of entries available.
+
+    """
+    global _generations_checked
+    snapshot = Snapshot(path)
+    previous, CACHE.snapshot = CACHE.snapshot, snapshot
+    if previous is not None:
+        previous.close()
+    if GENERATION_KEY in snapshot.counters and \
+            INVALIDATIONS_KEY in snapshot.counters:
+        with _GENERATIONS_LOCK:
+            _GENERATIONS.update(snapshot.counters)
+            _generations_checked = 0
+    return len(snapshot)
+
+
+def stats():
+    """Return the instance cache statistics.
+
+    Return:
+        (dict) `{'entries': int, 'bytes': int, 'keys': {group: counters}}`,
+        see `CacheStats`.
+
+    """
+    return {'entries': len(CACHE), 'bytes': CACHE.size, 'keys': STATS.get()}
+
+
+def reset_stats():
+    """Reset the instance cache counters."""
+    STATS.reset()
+
+
+def _incr_generation():
+    """Increment the generation counter in memcache."""
+    _GENERATIONS[GENERATION_KEY] = memcache.incr(GENERATION_KEY,
+                                                 initial_value=0)
+
+
+def _invalidate(key):
+    """Log a key deleted from all the instances in memcache."""
+    number = memcache.incr(INVALIDATIONS_KEY, initial_value=0)
+    if number is not None:
+        memcache.set('{}:{}'.format(INVALIDATIONS_KEY, number), key,
+                     time=86400)
+
+
+def _clear_stores():
+    """Reset the instance stores."""
+    for store in [CACHE] + _SHARED_STORES:
+        store.clear()
+
+
+def check_generations():
+    """Remove the entries invalidated by another instance.
+
+    The generation and invalidations counters are read from memcache at
+    most once every `cache_generation_interval` seconds, in a single RPC
+    whatever the keys read. The keys deleted since the last check are then
+    read in one more RPC, the whole cache is reset if some are missing or
+    if there are more than `MAX_INVALIDATIONS`.
+
+    Only one thread checks at a time, the others skip the check.
+    """
+    global _generations_checked
+    if memcache is None:
+        return
+    if _generations_checked + cache_generation_interval > time.time():
+        return
+    if not _GENERATIONS_LOCK.acquire(False):
+        return
+    try:
+        now = time.time()
+        # Another thread may have checked since the first test.
+        if _generations_checked + cache_generation_interval > now:
+            return
+        _generations_checked = now
+        _check_generations()
+    finally:
+        _GENERATIONS_LOCK.release()
+
+
+def _check_generations():
+    """Check the counters, the generations lock must be held."""
+    try:
+        counters = memcache.get_multi([GENERATION_KEY, INVALIDATIONS_KEY])
+    except Exception:  # pylint: disable=W0703
+        logging.warning('Cache generations check failed', exc_info=True)
+        return
+    known_generation = _GENERATIONS.get(GENERATION_KEY, MISSING)
+    known_number = _GENERATIONS.get(INVALIDATIONS_KEY)
+    generation = _GENERATIONS[GENERATION_KEY] = counters.get(GENERATION_KEY)
+    number = _GENERATIONS[INVALIDATIONS_KEY] = \
+        counters.get(INVALIDATIONS_KEY) or 0
+    if known_generation is MISSING:
+        return
+    if known_generation != generation:
+        _clear_stores()
+        return
+    if known_number is None or known_number == number:
+        return
+    if not 0 < number - known_number <= MAX_INVALIDATIONS:
+        _clear_stores()
+        return
+    log_keys = ['{}:{}'.format(INVALIDATIONS_KEY, log_number)
+                for log_number in range(known_number + 1, number + 1)]
+    try:
+        keys = memcache.get_multi(log_keys)
+    except Exception:  # pylint: disable=W0703
+        logging.warning('Cache invalidations check failed', exc_info=True)
+        keys = {}
+    if len(keys) < len(log_keys):
+        _clear_stores()
+        return
+    for key in keys.values():
+        for store in [CACHE] + _SHARED_STORES:
+            store.pop(key, None)
+
+
+def get_multi(containers):
+    """Return the values of several containers.
+
+    Values missing from the instance cache are fetched from memcache with a
+    single RPC, the remaining ones are computed.
+
+    Args:
+        containers (list) -- `CacheContainer` instances.
 
+    Return:
+        (list) Values in the order of `containers`.
 
-def flush():
-    """Reset the cache of the current instance, not all the instances."""
-    global CACHE
-    CACHE = {}
+    """
+    check_generations()
+    values = [None] * len(containers)
+    missing = []
+    for index, container in enumerate(containers):
+        entry = container._store.get(container.key)
+        if entry is not None:
+            STATS.incr(container.key, hits=1)
+            values[index] = container._serve(entry)
+        else:
+            missing.append(index)
+    shared = [index for index in missing
+              if containers[index].use_memcache]
+    if shared:
+        mkeys = [containers[index]._memcache_key for index in shared]
+        entries = memcache.get_multi(mkeys)
+        now = time.time()
+        for index, mkey in zip(shared, mkeys):
+            entry = entries.get(mkey)
+            if entry is None or entry[1] <= now:
+                continue
+            containers[index]._store.set(containers[index].key, *entry)
+            STATS.incr(containers[index].key, hits=1)
+            values[index] = containers[index]._serve(entry)
+            missing.remove(index)
+    for index in missing:
+        values[index] = containers[index]._value_missing()
+    return values
 
 
 class CacheContainer(object):
     """Generic cache container for "per instance" data.
 
+    With `stale_validity`, a value older than `validity` is still served
+    during `stale_validity` seconds while it is refreshed in background.
+
+    With `use_memcache`, values are also stored in memcache and shared by
+    all the instances: an instance missing a value reads it from memcache
+    before computing it.
+
+    `delete(all_instances=True)` and `flush(all_instances=True)` invalidate
+    the value in every instance through counters in memcache, checked once
+    every `cache_generation_interval` seconds.
+
+    Empty values are cached like any other value. With `negative_validity`,
+    values for which `is_negative` returns True, e.g. "not found" answers,
+    expire after `negative_validity` seconds instead of `validity`.
+
     Attribute:
         key (str) -- Object key in cache.
         validity (int) -- Cache validity in seconds.
+        negative_validity (int) -- Cache validity in seconds of negative
+            values, defaults to `validity`.
+        stale_validity (int) -- Time in seconds an expired value is served
+            while being refreshed.
+        wait_timeout (int) -- Maximum time in seconds a thread waits for
+            another thread computing the same value.
+        use_memcache (bool) -- Share values between instances in memcache.
+        store (object) -- Cache store, e.g. a `SharedMemoryCache`, defaults
+            to the instance cache `CACHE`.
     """
 
     key = None
     validity = 21600  # 6 hours
+    negative_validity = None
+    stale_validity = 0
+    wait_timeout = 10
+    use_memcache = False
+    store = None
 
     @property
     def value(self):
         """Return value from cache."""
-        value = self.get()
-        if value:
-            return value
-        value = self.update()
-        return value
+        entry = self._get_entry()
+        if entry is not None:
+            STATS.incr(self.key, hits=1)
+            return self._serve(entry)
+        return self._value_missing()
 
-    def get(self):
-        """Get the data associated to the key or a None."""
-        global CACHE
-        if self.key not in CACHE:
-            return None
-        value, expiration = CACHE[self.key]
-        now = time.time()
-        if expiration is None or now < expiration:
-            return value
-        else:
-            self.delete()
-            return None
+    def get(self, default=None):
+        """Get the data associated to the key or `default`."""
+        entry = self._get_entry()
+        if entry is None or self._is_stale(entry):
+            return default
+        return entry[0]
 
     def set(self, value, expiration=None):
         """Set data in cache."""
         if self.key is None:
             raise ValueError('CacheContainer.key must be set.')
-        global CACHE
         if expiration is None:
-            expiration = time.time() + self.validity
+            validity = self.validity
+            if self.negative_validity is not None and self.is_negative(value):
+                validity = self.negative_validity
+            expiration = time.time() + validity
         msg = 'Set cache for {}'.format(self.key)
-        logging.info(msg)
-        CACHE[self.key] = (value, expiration)
+        logging.debug(msg)
+        expiration_max = expiration + self.stale_validity
+        self._store.set(self.key, value, expiration_max)
+        if self.use_memcache:
+            memcache.set(self._memcache_key, (value, expiration_max),
+                         time=int(expiration_max))
         return (value, expiration)
 
-    def delete(self):
-        """Delete data from cache."""
-        global CACHE
-        CACHE.pop(self.key, None)
+    def delete(self, all_instances=False):
+        """Delete data from cache.
+
+        Args:
+            all_instances (bool) -- Also delete data from the other instances,
+                within `cache_generation_interval` seconds.
+        """
+        if all_instances:
+            _invalidate(self.key)
+        self._store.pop(self.key, None)
+        if self.use_memcache:
+            memcache.delete(self._memcache_key)
 
     def update(self):
         """Update cache."""
+        start = time.time()
         value = self.fresh_value
+        STATS.incr(self.key, recomputes=1, recompute_time=time.time() - start)
         self.set(value)
         return value
 
+    def is_negative(self, value):
+        """Return True if value is a negative result, e.g. empty or None."""
+        return not value
+
+    def refresh(self):
+        """Update cache unless another thread is already updating it."""
+        leader, event = self._start_update()
+        if not leader:
+            return
+        try:
+            self.update()
+        finally:
+            self._end_update(event)
+
+    def refresh_async(self):
+        """Refresh cache in a background thread.
+
+        No thread is started while the key is already being refreshed.
+        Override to refresh by other means, e.g. a deferred task.
+        """
+        leader, event = self._start_update()
+        if not leader:
+            return
+        thread = threading.Thread(target=self._refresh_logged, args=(event,))
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:
+            self._end_update(event)
+            raise
+
+    def _refresh_logged(self, event):
+        """Refresh cache and log errors, the value is served stale."""
+        try:
+            self.update()
+        except Exception:  # pylint: disable=W0703
+            logging.exception('Refresh cache for {} failed'.format(self.key))
+        finally:
+            self._end_update(event)
+
+    @property
+    def _store(self):
+        """Return the store of the container."""
+        return CACHE if self.store is None else self.store
+
+    @property
+    def _memcache_key(self):
+        """Return the key of the value in memcache.
+
+        The key changes with the global generation so values are not read
+        back from memcache after `flush(all_instances=True)`.
+        """
+        generation = _GENERATIONS.get(GENERATION_KEY) or 0
+        return '{}{}:{}'.format(MEMCACHE_PREFIX, generation, self.key)
+
+    def _get_entry(self):
+        """Return the `(value, expiration)` entry from cache or None."""
+        check_generations()
+        entry = self._store.get(self.key)
+        if entry is not None or not self.use_memcache:
+            return entry
+        entry = memcache.get(self._memcache_key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        self._store.set(self.key, *entry)
+        return entry
+
+    def _value_missing(self):
+        """Return the value of a key missing from cache."""
+        STATS.incr(self.key, misses=1)
+        return self._update_once()
+
+    def _serve(self, entry):
+        """Return the entry value, refreshed in background if stale."""
+        if self._is_stale(entry):
+            self.refresh_async()
+        return entry[0]
+
+    def _is_stale(self, entry):
+        """Return True if the entry is older than `validity`."""
+        expiration = entry[1]
+        return expiration is not None and \
+            expiration - self.stale_validity <= time.time()
+
+    def _start_update(self):
+        """Register the current thread as computing key.
+
+        Return:
+            (leader, event) -- `leader` is False if another thread is already
+            computing the key, `event` is set when the computation ends.
+
+        """
+        with _INFLIGHT_LOCK:
+            event = _INFLIGHT.get(self.key)
+            if event is not None:
+                return False, event
+            event = _INFLIGHT[self.key] = threading.Event()
+            return True, event
+
+    def _end_update(self, event):
+        """Unregister the thread computing key and wake up waiting ones."""
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(self.key, None)
+        event.set()
+
+    def _update_once(self):
+        """Update cache, only one thread at a time computes a key.
+
+        Threads missing the same key wait for the thread already computing
+        it and return its value. They compute the value themselves if it
+        fails or takes more than `wait_timeout`.
+        """
+        leader, event = self._start_update()
+        if not leader:
+            event.wait(self.wait_timeout)
+            value = self._get_stored()
+            if value is not MISSING:
+                return value
+            return self.update()
+        try:
+            # The value may have been set since our cache miss.
+            value = self._get_stored()
+            if value is not MISSING:
+                return value
+            return self.update()
+        finally:
+            self._end_update(event)
+
+    def _get_stored(self):
+        """Return the fresh value from the store or `MISSING`.
+
+        Memcache isn't read again: callers missed it already and the
+        thread computing the value sets it in the store.
+        """
+        entry = self._store.get(self.key)
+        if entry is None or self._is_stale(entry):
+            return MISSING
+        return entry[0]
+
     @property
     def fresh_value(self):
         """Return an updated value to set in cache."""
         raise NotImplementedError()
+
+
+class FunctionCacheContainer(CacheContainer):
+    """Cache container for the result of a function call.
+
+    Attribute:
+        func (callable) -- Function computing the value.
+        args (tuple) -- Function positional arguments.
+        kwargs (dict) -- Function keyword arguments.
+    """
+
+    def __init__(self, key, func, args, kwargs):
+        """Set key and function call."""
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    @property
+    def fresh_value(self):
+        """Return the function result."""
+        return self.func(*self.args, **self.kwargs)
+
+
+def cached(validity=CacheContainer.validity, key_func=None, **options):
+    """Memoize a function in cache, per arguments.
+
+    Example:
+
+        @cached(validity=600, key_func=lambda user_id: str(user_id))
+        def get_user_settings(user_id):
+            ...
+
+        get_user_settings.invalidate(user_id)
+
+    Args:
+        validity (int) -- Cache validity in seconds.
+        key_func (callable) -- Return a key from the function arguments,
+            defaults to a hash of the arguments repr.
+        options -- Other `CacheContainer` attributes, e.g. `stale_validity`
+            or `use_memcache`.
+
+    Return:
+        (callable) Decorator.
+
+    """
+    def decorator(func):
+        """Return the memoized function."""
+        prefix = '{}.{}'.format(func.__module__, func.__name__)
+        attrs = dict(options, validity=validity)
+        container_class = type(str('FunctionCacheContainer'),
+                               (FunctionCacheContainer,), attrs)
+
+        def container(*args, **kwargs):
+            """Return the cache container of a call."""
+            if key_func is not None:
+                suffix = key_func(*args, **kwargs)
+            else:
+                arguments = repr((args, sorted(kwargs.items())))
+                suffix = hashlib.sha1(arguments.encode('utf-8')).hexdigest()
+            key = '{}:{}'.format(prefix, suffix)
+            return container_class(key, func, args, kwargs)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """Return the function result from cache."""
+            return container(*args, **kwargs).value
+
+        def invalidate(*args, **kwargs):
+            """Delete the result of a call from cache."""
+            container(*args, **kwargs).delete()
+
+        wrapper.container = container
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
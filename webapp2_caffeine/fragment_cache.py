@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Jinja2 extension caching template fragments."""
+import hashlib
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from webapp2_caffeine.cache import FunctionCacheContainer
+
+
+class FragmentCacheExtension(Extension):
+    """Cache the output of a template block.
+
+    Example:
+
+        {% cache 'menu', 600, view.LANGUAGE %}
+            ...
+        {% endcache %}
+
+    The first argument names the fragment, the optional second one is the
+    validity in seconds, the next ones are values the fragment varies on,
+    e.g. the language or the user id.
+
+    Set `fragment_cache_use_memcache` on the environment to share the
+    fragments between instances.
+    """
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        """Set the environment defaults."""
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache_use_memcache=False)
+
+    def parse(self, parser):
+        """Parse `{% cache name[, validity[, vary...]] %}`."""
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        validity = nodes.Const(None)
+        vary_on = []
+        if parser.stream.skip_if('comma'):
+            validity = parser.parse_expression()
+            while parser.stream.skip_if('comma'):
+                vary_on.append(parser.parse_expression())
+        args = [name, validity, nodes.List(vary_on)]
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args),
+                               [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, name, validity, vary_on, caller):
+        """Return the fragment from cache or render it."""
+        # Hash the name too: it may be unicode, cache keys are str.
+        digest = hashlib.sha1(
+            repr((name, vary_on)).encode('utf-8')).hexdigest()
+        key = 'fragment:{}'.format(digest)
+        container = FunctionCacheContainer(key, caller, (), {})
+        if validity is not None:
+            container.validity = validity
+        container.use_memcache = self.environment.fragment_cache_use_memcache
+        return container.value
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 """Generic requests handlers."""
 import datetime
+import hashlib
+import json
+import os
 from operator import itemgetter
 
 from google.appengine.ext import ndb
@@ -14,6 +17,9 @@ from webapp2_extras import jinja2
 from webapp2_extras import sessions
 from webapp2_extras import sessions_memcache
 
+from webapp2_caffeine import cache
+from webapp2_caffeine.pagination import Pager
+
 
 try:
     from appengine_config import template_loaders
@@ -35,7 +41,8 @@ except ImportError:
     language_code = 'en_US'
 
 
-EXTENSIONS = ['jinja2.ext.autoescape', 'jinja2.ext.with_', 'jinja2.ext.i18n']
+EXTENSIONS = ['jinja2.ext.autoescape', 'jinja2.ext.with_', 'jinja2.ext.i18n',
+              'webapp2_caffeine.fragment_cache.FragmentCacheExtension']
 
 
 def jinja2_factory(app, loaders=None):
@@ -59,9 +66,14 @@ def jinja2_factory(app, loaders=None):
 
 
 class BaseRequestHandler(RequestHandler):
-    """Base request handler with session support and Jinja2 templates."""
+    """Base request handler with session support and Jinja2 templates.
+
+    Sessions are loaded on first access and only the modified ones are
+    saved. Set `render_user_info` to False to render templates without
+    `user`, anonymous pages then don't read the auth session.
+    """
 
-    session_store = None
+    render_user_info = True
 
     @cached_property
     def auth(self):
@@ -107,6 +119,11 @@ class BaseRequestHandler(RequestHandler):
         """
         return self.auth.store.user_model
 
+    @cached_property
+    def session_store(self):
+        """Return the session store of the request, created on first use."""
+        return sessions.get_store(request=self.request)
+
     @cached_property
     def session(self):
         """Shortcut to access the current session."""
@@ -118,11 +135,36 @@ class BaseRequestHandler(RequestHandler):
         """Return a Jinja2 renderer cached in the app registry."""
         return jinja2.get_jinja2(factory=jinja2_factory, app=self.app)
 
+    def render_template(self, _template, **context):
+        """Return a rendered template."""
+        if self.render_user_info:
+            context.update({'user': self.user_info})
+        context = self.resolve_context(context)
+        return self.jinja2.render_template(_template, **context)
+
+    def resolve_context(self, context):
+        """Replace the futures of a template context by their results.
+
+        Futures, e.g. from `get_async()`, `fetch_async()` or tasklets, are
+        waited for together so their RPCs run in parallel.
+
+        Args:
+            context (dict) -- Template context.
+
+        Return:
+            (dict) Context without futures.
+
+        """
+        futures = dict((name, value) for name, value in context.iteritems()
+                       if isinstance(value, ndb.Future))
+        ndb.Future.wait_all(futures.values())
+        for name, future in futures.iteritems():
+            context[name] = future.get_result()
+        return context
+
     def render_html(self, _template, **context):
         """Render a template and writes the result to the response."""
-        context.update({'user': self.user_info})
-        resp = self.jinja2.render_template(_template, **context)
-        self.response.write(resp)
+        self.response.write(self.render_template(_template, **context))
 
     @classmethod
     def _extract_locale_from_header(cls, locale_header):
@@ -178,13 +220,13 @@ class BaseRequestHandler(RequestHandler):
         self.LANGUAGE = i18n.get_i18n().locale[0:2]
 
     def dispatch(self):
-        """Override the dispatcher in order to set session."""
-        # Get a session store for this request.
-        self.session_store = sessions.get_store()
+        """Override the dispatcher in order to save sessions."""
         try:
             super(BaseRequestHandler, self).dispatch()
         finally:
-            self.session_store.save_sessions(self.response)
+            # Sessions may only be loaded by the session store or by auth.
+            if 'session_store' in self.__dict__ or 'auth' in self.__dict__:
+                self.session_store.save_sessions(self.response)
 
     def get_geodata(self):
         """Return `Request` geo data dict."""
@@ -216,16 +258,86 @@ class ImproperlyConfigured(Exception):
 
 
 class TemplateRequestHandler(BaseRequestHandler):
-    """Generic handler for template view."""
+    """Generic handler for template view.
+
+    `get_context_data` may return ndb futures, e.g. from `get_async()` or
+    tasklets: they are resolved together before rendering. The built-in
+    handlers return values, so subclasses can read them.
+
+    With `cache_timeout`, rendered pages are cached per path and per
+    `cache_vary_on` values:
+        'locale' -- the request locale,
+        'query' -- the query parameters,
+        'user' -- the logged in user or anonymous.
+    Pages rendered with `user` in context always vary on the user, set
+    `render_user_info` to False to share them between users. Cached pages
+    are rendered by `render_page`, not `render_html`, and keep the response
+    status and Content-Type: other headers set while rendering are not
+    cached.
+
+    Attribute:
+        cache_timeout (int) -- Page cache validity in seconds, 0 disables
+            the page cache.
+        cache_vary_on (tuple) -- Request values the page varies on.
+        cache_use_memcache (bool) -- Share pages between instances.
+    """
 
     template_name = None
+    cache_timeout = 0
+    cache_vary_on = ('locale',)
+    cache_use_memcache = False
 
     def get(self, *args, **kwargs):
         """Render template."""
+        if self.cache_timeout:
+            status, content_type, body = self.get_page_cache(**kwargs).value
+            self.response.set_status(status)
+            self.response.headers['Content-Type'] = content_type
+            self.response.write(body)
+            return
         context = self.get_context_data(**kwargs)
         template = self.get_template_name()
         self.render_html(template, **context)
 
+    def render_page(self, **kwargs):
+        """Return the rendered page."""
+        context = self.get_context_data(**kwargs)
+        template = self.get_template_name()
+        return self.render_template(template, **context)
+
+    def _render_cached_page(self, **kwargs):
+        """Return the status, Content-Type and body of the rendered page."""
+        body = self.render_page(**kwargs)
+        return (self.response.status_int,
+                self.response.headers.get('Content-Type'), body)
+
+    def get_page_cache(self, **kwargs):
+        """Return the cache container of the page."""
+        container = cache.FunctionCacheContainer(
+            self.get_page_cache_key(), self._render_cached_page, (), kwargs)
+        container.validity = self.cache_timeout
+        container.use_memcache = self.cache_use_memcache
+        return container
+
+    def get_page_cache_key(self):
+        """Return the page cache key of the request."""
+        parts = self.get_page_cache_parts()
+        digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+        return '{}.{}:{}'.format(self.__class__.__module__,
+                                 self.__class__.__name__, digest)
+
+    def get_page_cache_parts(self):
+        """Return the values the page varies on."""
+        parts = [self.request.path]
+        if 'locale' in self.cache_vary_on:
+            parts.append(i18n.get_i18n().locale)
+        if 'query' in self.cache_vary_on:
+            parts.append(sorted(self.request.GET.items()))
+        if 'user' in self.cache_vary_on or self.render_user_info:
+            user = self.user_info
+            parts.append(user['user_id'] if user else None)
+        return parts
+
     def get_template_name(self):
         """Return a template name to be used for the request."""
         if self.template_name is None:
@@ -244,9 +356,29 @@ class TemplateRequestHandler(BaseRequestHandler):
 
 
 class ModelRequestHandler(TemplateRequestHandler):
-    """To render an entity."""
+    """To render an entity.
+
+    Responses carry an ETag and a Last-Modified header computed from the
+    entity key and its `updated_property` or `version_property`: when
+    they match the request conditional headers, the handler answers 304
+    without rendering. Without these properties and with
+    `etag_from_content`, the ETag is the hash of the rendered page.
+
+    The ETag also changes with the deployed version, Last-Modified only
+    with the entity: after a deploy, clients sending only If-Modified-Since
+    keep their copy until the entity changes. Cached pages vary on the
+    entity validators.
+
+    Attribute:
+        updated_property (str) -- Name of the entity update datetime.
+        version_property (str) -- Name of the entity version.
+        etag_from_content (bool) -- Hash the rendered page to set the ETag.
+    """
 
     model = None
+    updated_property = None
+    version_property = None
+    etag_from_content = False
     _entity = None
 
     def get(self, *args, **kwargs):
@@ -255,7 +387,57 @@ class ModelRequestHandler(TemplateRequestHandler):
             self._set_entity(kwargs.get('object_id'))
             if not self._entity:
                 return self.response.set_status(404)
+            if self.set_validators() and self.is_not_modified():
+                return self.response.set_status(304)
         super(ModelRequestHandler, self).get(*args, **kwargs)
+        if self.etag_from_content and self.response.etag is None:
+            self.response.md5_etag()
+            if self.is_not_modified():
+                self.response.clear()
+                self.response.set_status(304)
+
+    def set_validators(self):
+        """Set the response ETag and Last-Modified from the entity.
+
+        Return:
+            (bool) True if the entity has a validator.
+
+        """
+        updated, version = self.get_validators()
+        if updated is None and version is None:
+            return False
+        if updated is not None:
+            self.response.last_modified = updated
+        # The page also depends on the request and on the deployed version.
+        parts = self.get_page_cache_parts()
+        parts.append(os.environ.get('CURRENT_VERSION_ID'))
+        self.response.etag = hashlib.sha1(repr(parts)).hexdigest()
+        return True
+
+    def get_validators(self):
+        """Return the entity update datetime and version, None if unset."""
+        updated = getattr(self._entity, self.updated_property) \
+            if self._entity and self.updated_property else None
+        version = getattr(self._entity, self.version_property) \
+            if self._entity and self.version_property else None
+        return updated, version
+
+    def get_page_cache_parts(self):
+        """Add the entity key and validators to the page cache parts."""
+        parts = super(ModelRequestHandler, self).get_page_cache_parts()
+        updated, version = self.get_validators()
+        if updated is not None or version is not None:
+            parts.extend([self._entity.key.urlsafe(), version, updated])
+        return parts
+
+    def is_not_modified(self):
+        """Return True if the request validators match the response."""
+        if self.request.headers.get('If-None-Match'):
+            return self.response.etag in self.request.if_none_match
+        if_modified_since = self.request.if_modified_since
+        last_modified = self.response.last_modified
+        return bool(if_modified_since and last_modified and
+                    last_modified <= if_modified_since)
 
     def get_context_data(self, **kwargs):
         """Add model entity to context."""
@@ -266,40 +448,80 @@ class ModelRequestHandler(TemplateRequestHandler):
 
     def _set_entity(self, object_id):
         """Set model entity."""
+        self._set_entity_async(object_id).get_result()
+
+    @ndb.tasklet
+    def _set_entity_async(self, object_id):
+        """Set model entity asynchronously, with `model.get_by_id_async`."""
         try:
             object_id = int(object_id)
         except ValueError:
             pass
+        parent = None
         if self.request.route_kwargs.get('parent_id'):
             parent_id = self.request.route_kwargs.get('parent_id')
             try:
                 parent_id = int(parent_id)
             except ValueError:
                 pass
-            key = ndb.Key(self.model.parent_class, parent_id,
-                          self.model, object_id)
-            self._entity = key.get()
-        else:
-            self._entity = self.model.get_by_id(object_id)
+            parent = ndb.Key(self.model.parent_class, parent_id)
+        self._entity = yield self.model.get_by_id_async(object_id,
+                                                        parent=parent)
 
 
 class ChildsRequestHandler(TemplateRequestHandler):
-    """To render list of an entity childrens."""
+    """To render list of an entity childrens.
+
+    Children are paginated by a `Pager` on the `page_param` query
+    parameter, the pager is in context as `pager`. Cached pages vary on
+    the query parameters, the page number included.
+
+    Attribute:
+        limit (int) -- Page size.
+        page_param (str) -- Query parameter of the page number.
+        projection (list) -- Properties of a projection query, fetch full
+            entities if None.
+        hydrate (bool) -- Fetch the page keys only, then the entities with
+            `ndb.get_multi_async`, from the ndb caches when possible.
+    """
 
     child_model = None
     parent_id_key = 'parent_id'
     limit = 20
+    page_param = 'page'
+    projection = None
+    hydrate = False
+    cache_vary_on = ('locale', 'query')
 
     def get_context_data(self, **kwargs):
-        """Add list items to context."""
+        """Add list items to context.
+
+        The parent and the children are fetched in parallel and returned
+        as values.
+        """
         kwargs = super(ChildsRequestHandler, self).get_context_data(**kwargs)
         ancestor = ndb.Key(self.child_model.parent_class,
                            kwargs[self.parent_id_key])
-        items = self.queryset(ancestor).fetch_async(self.limit)
-        parent = ancestor.get_async()
-        kwargs['parent'] = parent.get_result()
-        kwargs['items'] = items.get_result()
-        return kwargs
+        pager = self.get_pager(ancestor)
+        kwargs['parent'] = ancestor.get_async()
+        kwargs['items'] = self.get_items_async(pager)
+        kwargs['pager'] = pager
+        return self.resolve_context(kwargs)
+
+    def get_pager(self, ancestor):
+        """Return the pager of the requested page."""
+        page = self.request.GET.get(self.page_param, 1)
+        return Pager(self.queryset(ancestor), page=page, hydrate=self.hydrate)
+
+    @ndb.tasklet
+    def get_items_async(self, pager):
+        """Fetch the children of the page."""
+        q_options = {}
+        if self.projection:
+            q_options['projection'] = self.projection
+        results, dummy, dummy = yield pager.paginate_async(self.limit,
+                                                           **q_options)
+        raise ndb.Return(results)
 
     def queryset(self, ancestor):
         """Return child query."""
@@ -390,21 +612,25 @@ class ModelFormRequestHandler(FormRequestHandler):
 
     def _set_entity(self, object_id):
         """Set model entity."""
+        self._set_entity_async(object_id).get_result()
+
+    @ndb.tasklet
+    def _set_entity_async(self, object_id):
+        """Set model entity asynchronously, with `model.get_by_id_async`."""
         try:
             object_id = int(object_id)
         except ValueError:
             pass
+        parent = None
         if self.request.route_kwargs.get('parent_id'):
             parent_id = self.request.route_kwargs.get('parent_id')
             try:
                 parent_id = int(parent_id)
             except ValueError:
                 pass
-            key = ndb.Key(self.model.parent_class, parent_id,
-                          self.model, object_id)
-            self._entity = key.get()
-        else:
-            self._entity = self.model.get_by_id(object_id)
+            parent = ndb.Key(self.model.parent_class, parent_id)
+        self._entity = yield self.model.get_by_id_async(object_id,
+                                                        parent=parent)
 
     def form_valid(self, form):
         """Create entity and redirect."""
@@ -429,3 +655,16 @@ class ModelFormRequestHandler(FormRequestHandler):
         if self._entity:
             kwargs['object'] = self._entity
         return kwargs
+
+
+class CacheStatsRequestHandler(RequestHandler):
+    """Render the instance cache statistics in JSON.
+
+    Restrict its route to administrators, e.g. with `login: admin` in
+    `app.yaml`.
+    """
+
+    def get(self, *args, **kwargs):
+        """Write statistics."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(cache.stats(), sort_keys=True))
@@ -1,21 +1,154 @@
 # -*- coding: utf-8 -*-
 """Pager for ndb request."""
+import base64
+import datetime
 import hashlib
+import heapq
+import json
+import time
 
-from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import CompositeOrder
 from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.datastore.datastore_query import PropertyOrder
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+
+# Query options changing the pages of a query.
+PAGE_OPTIONS = ('keys_only', 'projection', 'offset', 'limit', 'distinct',
+                'group_by')
+
+
+def canonical_filters(node):
+    """Return a representation of filters independent of their order."""
+    if node is None:
+        return None
+    if isinstance(node, (ndb.ConjunctionNode, ndb.DisjunctionNode)):
+        return (node.__class__.__name__,
+                tuple(sorted(repr(canonical_filters(child))
+                             for child in node)))
+    return repr(node)
+
+
+def flatten_orders(order):
+    """Return the list of `(property name, direction)` of query orders."""
+    if order is None:
+        return []
+    if isinstance(order, CompositeOrder):
+        return [item for child in order.orders
+                for item in flatten_orders(child)]
+    return [(order.prop, order.direction)]
+
+
+def sort_value(entity, name):
+    """Return the value of an entity for a sort property name."""
+    if name == '__key__':
+        return entity.key
+    return getattr(entity, entity._properties[name]._code_name)
+
+
+class Descending(object):
+    """Wrap a sort value to reverse its order."""
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        """Set value."""
+        self.value = value
+
+    def __eq__(self, other):
+        """Return True if values are equal."""
+        return self.value == other.value
+
+    def __ne__(self, other):
+        """Return True if values are not equal."""
+        return self.value != other.value
+
+    def __lt__(self, other):
+        """Return True if value is greater than the other value."""
+        return other.value < self.value
+
+
+def encode_value(value):
+    """Return a JSON serializable `[type, value]` for a sort value."""
+    if value is None:
+        return ['n', None]
+    if isinstance(value, bool):
+        return ['b', value]
+    if isinstance(value, (int, long, float, basestring)):
+        return ['v', value]
+    if isinstance(value, datetime.datetime):
+        return ['dt', value.strftime('%Y-%m-%dT%H:%M:%S.%f')]
+    if isinstance(value, datetime.date):
+        return ['d', value.strftime('%Y-%m-%d')]
+    if isinstance(value, ndb.Key):
+        return ['k', value.urlsafe()]
+    raise ValueError('Unsupported sort value {!r}'.format(value))
+
+
+def decode_value(item):
+    """Return the sort value of an `encode_value` result."""
+    kind, value = item
+    if kind in ('n', 'b', 'v'):
+        return value
+    if kind == 'dt':
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    if kind == 'd':
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if kind == 'k':
+        return ndb.Key(urlsafe=value)
+    raise ValueError('Unsupported sort value type {!r}'.format(kind))
+
+
+def canonical_orders(order):
+    """Return a representation of orders without object addresses."""
+    if order is None:
+        return None
+    if isinstance(order, CompositeOrder):
+        return tuple(canonical_orders(child) for child in order.orders)
+    if isinstance(order, PropertyOrder):
+        return (order.prop, order.direction)
+    return repr(order)
 
 
 class Pager(object):
-    """NDB pager."""
+    """NDB pager.
+
+    The cursor of the next page is cached in background when a page is
+    fetched. With `prefetch`, the cursors of the following pages are also
+    cached by a background tasklet. Wrap the application with
+    `ndb.toplevel` (see `middlewares.clear_event_queue`) to let them
+    complete.
+
+    `total_count` and `page_count` count at most `count_limit` entities.
+    The count is cached in memcache and refreshed in background once older
+    than `count_refresh` seconds.
+
+    With `hydrate`, pages are fetched keys only and entities are read with
+    `ndb.get_multi_async`, from the ndb caches when possible. With
+    `results_lifetime`, the keys of a page are also cached in memcache for
+    that many seconds: new or reordered entities may then show up late.
+    """
 
     has_next = False  # Next page exists.
-    __query_id = ''  # Quary hash.
+    max_offset = 10000  # Maximum entities walked to reach a page.
+    page_size = 20  # Page size of the last fetched page.
+    count_limit = 1000  # Maximum entities counted.
+    count_refresh = 300  # Cached count age before a refresh, in seconds.
+    iter_cursor = None  # Cursor of the batch `iter_all` is processing.
+    _total_count = None
 
-    def __init__(self, query, page=0, lifetime=3600):
+    def __init__(self, query, page=0, lifetime=3600, prefetch=0,
+                 hydrate=False, results_lifetime=0):
         """Set pager attributes."""
         self.query = query
         self.lifetime = lifetime
+        self.prefetch = prefetch
+        self.hydrate = hydrate
+        self.results_lifetime = results_lifetime
+        self._query_hash = None
+        self._fingerprints = {}
         try:
             self.page = int(page)
         except ValueError:
@@ -34,58 +167,309 @@ class Pager(object):
             (results, cursor, more)
 
         """
-        cursor = self._get_cursor(self.page, page_size, **q_options)
-        results, cursor, more = self.query.fetch_page(page_size,
-                                                      start_cursor=cursor,
-                                                      **q_options)
+        return self.paginate_async(page_size, **q_options).get_result()
+
+    @ndb.tasklet
+    def paginate_async(self, page_size=20, **q_options):
+        """Fetch page asynchronously.
+
+        Args:
+            page_size (int)
+            q_options (obj) -- Query options.
+
+        Return:
+            (Future) (results, cursor, more)
+
+        """
+        cached = False
+        if self.hydrate and not q_options.get('keys_only') and \
+                not q_options.get('projection'):
+            keys, cursor, more, cached = yield self._fetch_keys_async(
+                page_size, **q_options)
+            entities = yield ndb.get_multi_async(keys)
+            results = [entity for entity in entities if entity is not None]
+        else:
+            cursor = yield self._get_cursor_async(self.page, page_size,
+                                                  **q_options)
+            results, cursor, more = yield self.query.fetch_page_async(
+                page_size, start_cursor=cursor, **q_options)
+        self.page_size = page_size
         self.has_next = more
-        return results, cursor, more
+        if more and cursor is not None and not cached:
+            # Not waited for, like the prefetch.
+            self._set_cursors_to_cache_async({self.page + 1: cursor},
+                                             page_size, **q_options)
+            if self.prefetch:
+                self._prefetch_async(cursor, page_size, **q_options)
+        raise ndb.Return((results, cursor, more))
+
+    @ndb.tasklet
+    def _fetch_keys_async(self, page_size=20, **q_options):
+        """Fetch the keys of the page, from memcache if cached.
+
+        Return:
+            (Future) (keys, cursor, more, from cache)
+
+        """
+        ctx = ndb.get_context()
+        results_key = self._get_results_memcache_key(page_size, **q_options)
+        if self.results_lifetime:
+            cached = yield ctx.memcache_get(results_key)
+            if cached is not None:
+                keys, cursor, more = cached
+                cursor = Cursor.from_bytes(cursor) if cursor else None
+                raise ndb.Return((keys, cursor, more, True))
+        cursor = yield self._get_cursor_async(self.page, page_size,
+                                              **q_options)
+        keys, cursor, more = yield self.query.fetch_page_async(
+            page_size, start_cursor=cursor, keys_only=True, **q_options)
+        if self.results_lifetime:
+            value = (keys, cursor.to_bytes() if cursor else None, more)
+            yield ctx.memcache_set(results_key, value,
+                                   time=self.results_lifetime)
+        raise ndb.Return((keys, cursor, more, False))
+
+    def _get_results_memcache_key(self, page_size=20, **q_options):
+        """Return a unique key for the keys of the page."""
+        return '{}-results'.format(
+            self._get_memcache_key(self.page, page_size, **q_options))
+
+    @ndb.tasklet
+    def _prefetch_async(self, cursor, page_size=20, **q_options):
+        """Cache the cursors of the `prefetch` pages after the next one.
+
+        Args:
+            cursor (Cursor) -- Cursor of the next page.
+            page_size (int)
+            q_options (obj) -- Query options.
+        """
+        last_page = min(self.page + 1 + self.prefetch,
+                        max(1, self.max_offset // page_size))
+        pages = range(self.page + 2, last_page + 1)
+        cursors = yield self._get_cursors_from_cache_async(pages, page_size,
+                                                           **q_options)
+        new_cursors = {}
+        for page in pages:
+            if page in cursors:
+                cursor = cursors[page]
+                continue
+            dummy, cursor, more = yield self.query.fetch_page_async(
+                page_size, start_cursor=cursor, keys_only=True, **q_options)
+            if not more:
+                break
+            new_cursors[page] = cursor
+        yield self._set_cursors_to_cache_async(new_cursors, page_size,
+                                               **q_options)
+
+    def iter_all(self, batch_size=100, cursor=None, batches=False,
+                 **q_options):
+        """Iterate over all the entities of the query.
+
+        The next batch is fetched while the current one is processed, so at
+        most two batches are in memory. `iter_cursor` is the cursor at the
+        start of the batch being processed, save it to resume the iteration
+        later: that batch is then processed again. Once the iteration is
+        over, it is the cursor after the last batch.
+
+        Args:
+            batch_size (int)
+            cursor (Cursor) -- Cursor to resume from, or its urlsafe string.
+            batches (bool) -- Yield lists of entities instead of entities.
+            q_options (obj) -- Query options.
+
+        Yield:
+            Entities or lists of entities.
+
+        """
+        if isinstance(cursor, basestring):
+            cursor = Cursor(urlsafe=cursor)
+        self.iter_cursor = cursor
+        future = self.query.fetch_page_async(batch_size, start_cursor=cursor,
+                                             **q_options)
+        while future is not None:
+            results, cursor, more = future.get_result()
+            future = None
+            if more and cursor is not None:
+                # Read ahead.
+                future = self.query.fetch_page_async(
+                    batch_size, start_cursor=cursor, **q_options)
+            if batches:
+                yield results
+            else:
+                for entity in results:
+                    yield entity
+            # The batch is processed once the consumer asks for more.
+            if cursor is not None:
+                self.iter_cursor = cursor
 
     def _get_cursor(self, page, page_size=20, **q_options):
         """Return the cursor for the given page."""
-        # Check if cursor already exists.
-        curs = self._get_cursor_from_cache(page, page_size=20, **q_options)
-        if curs:
-            return curs
-        # Compute new cursor.
-        if self.page > 1:
-            # Get cursor.
-            for page in xrange(1, 10000 / page_size):
-                if page == self.page:
-                    break
-                dummy, curs, more = self.query.fetch_page(page_size,
-                                                          start_cursor=curs,
-                                                          keys_only=True,
-                                                          **q_options)
-                self._set_cursor_to_cache(curs, page, page_size, **q_options)
-                if not more:
-                    break
-        return curs
+        return self._get_cursor_async(page, page_size,
+                                      **q_options).get_result()
+
+    @ndb.tasklet
+    def _get_cursor_async(self, page, page_size=20, **q_options):
+        """Return the cursor for the given page.
+
+        The walk starts from the closest previous page with a cursor in
+        memcache, the cursors found on the way are cached.
+        """
+        page = min(page, max(1, self.max_offset // page_size))
+        if page <= 1:
+            raise ndb.Return(None)
+        # Find the last cached cursor.
+        cursors = yield self._get_cursors_from_cache_async(
+            xrange(2, page + 1), page_size, **q_options)
+        start = max(cursors) if cursors else 1
+        curs = cursors.get(start)
+        # Walk to the page.
+        new_cursors = {}
+        for current in xrange(start, page):
+            dummy, curs, more = yield self.query.fetch_page_async(
+                page_size, start_cursor=curs, keys_only=True, **q_options)
+            if not more:
+                break
+            new_cursors[current + 1] = curs
+        yield self._set_cursors_to_cache_async(new_cursors, page_size,
+                                               **q_options)
+        raise ndb.Return(curs)
 
     def _get_cursor_from_cache(self, page, page_size=20, **q_options):
-        cursor_key = self._get_memcache_key(page=page)
-        value = memcache.get(cursor_key)
-        if value:
-            return Cursor.from_bytes(value)
-        else:
-            return None
+        """Return the cursor of a page from memcache or None."""
+        cursors = self._get_cursors_from_cache([page], page_size, **q_options)
+        return cursors.get(page)
+
+    def _get_cursors_from_cache(self, pages, page_size=20, **q_options):
+        """Return the cursors `{page: Cursor}` found in memcache."""
+        return self._get_cursors_from_cache_async(pages, page_size,
+                                                  **q_options).get_result()
+
+    @ndb.tasklet
+    def _get_cursors_from_cache_async(self, pages, page_size=20,
+                                      **q_options):
+        """Return the cursors `{page: Cursor}` found in memcache.
+
+        The context batches the gets in a single memcache RPC.
+        """
+        ctx = ndb.get_context()
+        pages = list(pages)
+        values = yield [
+            ctx.memcache_get(self._get_memcache_key(page, page_size,
+                                                    **q_options))
+            for page in pages]
+        raise ndb.Return(dict((page, Cursor.from_bytes(value))
+                              for page, value in zip(pages, values)
+                              if value))
 
     def _set_cursor_to_cache(self, cursor, page, page_size=20, **q_options):
         """Set Cursor to memcahe."""
-        cursor_key = self._get_memcache_key(page=page)
-        memcache.add(cursor_key, cursor.to_bytes(), time=self.lifetime)
+        self._set_cursors_to_cache({page: cursor}, page_size, **q_options)
+
+    def _set_cursors_to_cache(self, cursors, page_size=20, **q_options):
+        """Set cursors `{page: Cursor}` to memcache."""
+        self._set_cursors_to_cache_async(cursors, page_size,
+                                         **q_options).get_result()
+
+    @ndb.tasklet
+    def _set_cursors_to_cache_async(self, cursors, page_size=20,
+                                    **q_options):
+        """Set cursors `{page: Cursor}` to memcache.
+
+        The context batches the sets in a single memcache RPC.
+        """
+        ctx = ndb.get_context()
+        yield [ctx.memcache_set(self._get_memcache_key(page, page_size,
+                                                       **q_options),
+                                cursor.to_bytes(), time=self.lifetime)
+               for page, cursor in cursors.iteritems()]
 
     @property
     def _query_id(self):
-        if not hasattr(self, '__query_id'):
-            hsh = hashlib.sha1()
-            hsh.update(repr(self.query))
-            self.__query_id = hsh.hexdigest()
-        return self.__query_id
+        """Return a hash of the query, stable between instances."""
+        if self._query_hash is None:
+            query = self.query
+            parts = (query.app, query.namespace, query.kind,
+                     repr(query.ancestor),
+                     canonical_filters(query.filters),
+                     canonical_orders(query.orders),
+                     query.projection, query.group_by)
+            self._query_hash = hashlib.sha1(repr(parts)).hexdigest()
+        return self._query_hash
+
+    def _fingerprint(self, page_size=20, **q_options):
+        """Return a hash of the query, page size and page options."""
+        options = repr((page_size, [(name, q_options.get(name))
+                                    for name in PAGE_OPTIONS]))
+        fingerprint = self._fingerprints.get(options)
+        if fingerprint is None:
+            hsh = hashlib.sha1(self._query_id)
+            hsh.update(options)
+            fingerprint = self._fingerprints[options] = hsh.hexdigest()
+        return fingerprint
+
+    def _get_memcache_key(self, page, page_size=20, **q_options):
+        """Return a unique key for query, options and Cursor."""
+        return '{}-{}-{}'.format(self.__class__.__name__,
+                                 self._fingerprint(page_size, **q_options),
+                                 page)
+
+    @property
+    def total_count(self):
+        """Return the number of entities, up to `count_limit`."""
+        if self._total_count is None:
+            self.total_count_async().get_result()
+        return min(self._total_count, self.count_limit)
+
+    @property
+    def count_limited(self):
+        """Return True if there are more than `total_count` entities."""
+        if self._total_count is None:
+            self.total_count_async().get_result()
+        return self._total_count > self.count_limit
+
+    @property
+    def page_count(self):
+        """Return the number of pages of `page_size`, at least 1."""
+        return max(1, -(-self.total_count // self.page_size))
+
+    @ndb.tasklet
+    def total_count_async(self):
+        """Return the number of entities from memcache or count them.
+
+        Return:
+            (Future) Number of entities, up to `count_limit`.
+
+        """
+        ctx = ndb.get_context()
+        cached = yield ctx.memcache_get(self._get_count_memcache_key())
+        if cached is None:
+            count = yield self._count_async()
+            raise ndb.Return(min(count, self.count_limit))
+        count, timestamp = cached
+        self._total_count = count
+        if timestamp + self.count_refresh < time.time():
+            # Delay other refreshes then refresh in background.
+            yield ctx.memcache_set(self._get_count_memcache_key(),
+                                   (count, time.time()), time=self.lifetime)
+            self._count_async()
+        raise ndb.Return(min(count, self.count_limit))
+
+    @ndb.tasklet
+    def _count_async(self):
+        """Count entities, keys only and up to `count_limit` + 1, and cache.
 
-    def _get_memcache_key(self, page):
-        """Return a unique key for query and Cursor."""
-        return '{}-{}-{}'.format(self.__class__.__name__, self._query_id, page)
+        One more entity than `count_limit` tells if the count is limited.
+        """
+        count = yield self.query.count_async(limit=self.count_limit + 1)
+        yield ndb.get_context().memcache_set(
+            self._get_count_memcache_key(), (count, time.time()),
+            time=self.lifetime)
+        self._total_count = count
+        raise ndb.Return(count)
+
+    def _get_count_memcache_key(self):
+        """Return a unique key for query count."""
+        return '{}-{}-count'.format(self.__class__.__name__, self._query_id)
 
     @property
     def has_prev(self):
@@ -111,3 +495,266 @@ class Pager(object):
     def __nonzero__(self):
         """Return True if previous page or next page, else False."""
         return self.has_prev or self.has_next
+
+
+class KeysetPager(object):
+    """NDB pager seeking pages from the last entity of the previous page.
+
+    A page token holds the sort values and the key of the last entity of
+    the previous page, they are turned into inequality filters. Any page is
+    fetched with one query and no cursor is stored, so tokens stay valid
+    across deploys and memcache evictions.
+
+    The entity key is added as last sort order to break ties. Sort orders
+    must be on single-valued properties of the query model, and the results
+    must include them (no `keys_only` unless sorted by key only).
+
+    Attributes:
+        token (str) -- Token of the page, None for the first page.
+        next_token (str) -- Token of the next page, None if no next page.
+    """
+
+    has_next = False  # Next page exists.
+    next_token = None
+
+    def __init__(self, query, token=None):
+        """Set pager attributes."""
+        self.query = query
+        self.model = ndb.Model._lookup_model(query.kind)
+        self.orders = flatten_orders(query.orders)
+        if not self.orders or self.orders[-1][0] != '__key__':
+            self.query = query.order(self.model.key)
+            self.orders.append(('__key__', PropertyOrder.ASCENDING))
+        # Tampered or stale tokens, from the query string, fall back to the
+        # first page.
+        self.values = self._filter = None
+        try:
+            if token:
+                values = self.decode_token(token)
+                self._filter = self._seek_filter(values)
+                self.values = values
+        except (TypeError, ValueError, datastore_errors.Error,
+                ProtocolBufferDecodeError):
+            self._filter = None
+        self.token = token if self.values else None
+
+    def paginate(self, page_size=20, **q_options):
+        """Fetch page and return results.
+
+        Args:
+            page_size (int)
+            q_options (obj) -- Query options.
+
+        Return:
+            (results, next token, more)
+
+        """
+        return self.paginate_async(page_size, **q_options).get_result()
+
+    @ndb.tasklet
+    def paginate_async(self, page_size=20, **q_options):
+        """Fetch page asynchronously.
+
+        Return:
+            (Future) (results, next token, more)
+
+        """
+        query = self.query
+        if self._filter is not None:
+            query = query.filter(self._filter)
+        results, dummy, more = yield query.fetch_page_async(page_size,
+                                                            **q_options)
+        self.has_next = bool(more and results)
+        self.next_token = self.encode_token(results[-1]) \
+            if self.has_next else None
+        raise ndb.Return((results, self.next_token, self.has_next))
+
+    def encode_token(self, entity):
+        """Return the token of the page following an entity (or key)."""
+        values = [encode_value(self._get_value(entity, name))
+                  for name, dummy in self.orders]
+        return base64.urlsafe_b64encode(json.dumps(values))
+
+    def decode_token(self, token):
+        """Return the sort values of a token."""
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+        if not isinstance(values, list) or len(values) != len(self.orders):
+            raise ValueError('Invalid page token')
+        return [decode_value(value) for value in values]
+
+    def _get_property(self, name):
+        """Return the model property for a datastore property name."""
+        if name == '__key__':
+            return self.model.key
+        return self.model._properties[name]
+
+    def _get_value(self, entity, name):
+        """Return the sort value of an entity."""
+        if isinstance(entity, ndb.Key):
+            if name != '__key__':
+                raise ValueError('Keys only pages must be sorted by key')
+            return entity
+        return sort_value(entity, name)
+
+    def _seek_filter(self, values):
+        """Return the filter of the entities after the sort values.
+
+        `(a > x) OR (a == x AND b > y) OR (a == x AND b == y AND key > k)`
+        for orders on `a`, `b` and the key.
+        """
+        clauses = []
+        for index, (name, direction) in enumerate(self.orders):
+            prop = self._get_property(name)
+            if direction == PropertyOrder.DESCENDING:
+                seek = prop < values[index]
+            else:
+                seek = prop > values[index]
+            equals = [self._get_property(previous) == value
+                      for (previous, dummy), value
+                      in zip(self.orders[:index], values[:index])]
+            clauses.append(ndb.AND(*(equals + [seek])) if equals else seek)
+        return ndb.OR(*clauses) if len(clauses) > 1 else clauses[0]
+
+    @property
+    def has_prev(self):
+        """Previous page exists."""
+        return self.token is not None
+
+    def __nonzero__(self):
+        """Return True if previous page or next page, else False."""
+        return self.has_prev or self.has_next
+
+
+class MergedPager(object):
+    """NDB pager over the union of several queries sorted the same way.
+
+    Pages are a k-way merge of the queries on their sort orders, with the
+    entity key as last sort order. Each query is read with its own iterator
+    in small batches, so it is only read as far as the page needs. Entities
+    matched by several queries are returned once.
+
+    A page token holds the cursors of all the queries after the last entity
+    of the previous page.
+
+    Attributes:
+        queries (list) -- Queries with the same sort orders.
+        token (str) -- Token of the page, None for the first page.
+        next_token (str) -- Token of the next page, None if no next page.
+        batch_size (int) -- Entities read per query RPC, defaults to the
+            page size split between the queries.
+    """
+
+    has_next = False  # Next page exists.
+    next_token = None
+    batch_size = None
+
+    def __init__(self, queries, token=None):
+        """Set pager attributes."""
+        self.queries = list(queries)
+        self.orders = [order for order in flatten_orders(
+            self.queries[0].orders) if order[0] != '__key__']
+        try:
+            self.cursors = self.decode_token(token) if token else None
+        except (TypeError, ValueError, datastore_errors.BadValueError):
+            self.cursors = None
+        self.token = token if self.cursors else None
+        if self.cursors is None:
+            # No cursor to start from the beginning of every query.
+            self.cursors = [''] * len(self.queries)
+
+    def paginate(self, page_size=20, **q_options):
+        """Fetch page and return results.
+
+        Args:
+            page_size (int)
+            q_options (obj) -- Query options.
+
+        Return:
+            (results, next token, more)
+
+        """
+        batch_size = self.batch_size or \
+            max(1, -(-page_size // len(self.queries)))
+        cursors = list(self.cursors)
+        iterators = {}
+        for index, query in enumerate(self.queries):
+            if cursors[index] is None:
+                continue
+            iterators[index] = query.iter(start_cursor=cursors[index] or None,
+                                          produce_cursors=True,
+                                          batch_size=batch_size,
+                                          **q_options)
+        # Read the first batch of every query in parallel.
+        futures = dict((index, iterator.has_next_async())
+                       for index, iterator in iterators.iteritems())
+        heap = []
+        for index, future in futures.iteritems():
+            if future.get_result():
+                self._push(heap, index, iterators[index].next())
+            else:
+                cursors[index] = None
+        results = []
+        last_key = None
+        while heap and len(results) < page_size:
+            dummy, index, entity = heapq.heappop(heap)
+            iterator = iterators[index]
+            cursors[index] = iterator.cursor_after()
+            if entity.key != last_key:
+                results.append(entity)
+                last_key = entity.key
+            self._advance(heap, index, iterator, cursors)
+        # Skip the other copies of the last entity.
+        while heap and heap[0][2].key == last_key:
+            dummy, index, entity = heapq.heappop(heap)
+            cursors[index] = iterators[index].cursor_after()
+            self._advance(heap, index, iterators[index], cursors)
+        self.has_next = bool(heap)
+        self.next_token = self.encode_token(cursors) \
+            if self.has_next else None
+        return results, self.next_token, self.has_next
+
+    def encode_token(self, cursors):
+        """Return the token of cursors, None for exhausted queries."""
+        return base64.urlsafe_b64encode(json.dumps(
+            [cursor.urlsafe() if isinstance(cursor, Cursor) else cursor
+             for cursor in cursors]))
+
+    def decode_token(self, token):
+        """Return the cursors of a token.
+
+        Cursors are None for exhausted queries, '' for queries to read from
+        the beginning, else `Cursor` objects.
+        """
+        cursors = json.loads(base64.urlsafe_b64decode(str(token)))
+        if not isinstance(cursors, list) or \
+                len(cursors) != len(self.queries) or \
+                not all(cursor is None or isinstance(cursor, basestring)
+                        for cursor in cursors):
+            raise ValueError('Invalid page token')
+        return [Cursor(urlsafe=cursor) if cursor else cursor
+                for cursor in cursors]
+
+    def _push(self, heap, index, entity):
+        """Push an entity in the merge heap."""
+        values = [Descending(sort_value(entity, name))
+                  if direction == PropertyOrder.DESCENDING
+                  else sort_value(entity, name)
+                  for name, direction in self.orders]
+        values.append(entity.key.flat())
+        heapq.heappush(heap, (values, index, entity))
+
+    def _advance(self, heap, index, iterator, cursors):
+        """Push the next entity of a query, or mark the query exhausted."""
+        if iterator.has_next():
+            self._push(heap, index, iterator.next())
+        else:
+            cursors[index] = None
+
+    @property
+    def has_prev(self):
+        """Previous page exists."""
+        return self.token is not None
+
+    def __nonzero__(self):
+        """Return True if previous page or next page, else False."""
+        return self.has_prev or self.has_next